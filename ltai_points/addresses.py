@@ -0,0 +1,30 @@
+""" Shared address normalizer.
+
+Checksumming an address runs keccak, and the same few thousand addresses are
+checksummed over and over during a run (every reward increment, every bonus
+and allocation lookup). We memoize lowercase -> checksum with a bounded LRU and
+intern the results so equal addresses also share the same string object.
+"""
+from functools import lru_cache
+import sys
+
+import web3
+
+ADDRESS_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _checksum_lowercase_address(address):
+    return sys.intern(web3.Web3.to_checksum_address(address))
+
+
+def to_checksum_address(address):
+    """ Memoized drop-in for `Web3.to_checksum_address` """
+    if isinstance(address, str):
+        address = address.lower()
+    return _checksum_lowercase_address(address)
+
+
+def get_address_cache_info():
+    """ Hits, misses and size of the checksum cache """
+    return _checksum_lowercase_address.cache_info()
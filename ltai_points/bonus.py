@@ -0,0 +1,55 @@
+""" Bonus eligibility index.
+
+Registrations are sorted by time once per run, so the set of addresses getting
+the bonus at a given reward time is a bisect away, and the frozensets are shared
+by all the rounds with the same eligible registrations.
+"""
+from bisect import bisect_left
+
+from .addresses import to_checksum_address
+
+
+class BonusIndex:
+    def __init__(self, registrations, settings):
+        self.registrations = registrations
+        self.settings = settings
+        entries = sorted((registration_time, to_checksum_address(address))
+                         for address, registration_time in registrations.items()
+                         if registration_time < settings['bonus_limit_ts'])
+        self.times = [registration_time for registration_time, _ in entries]
+        # addresses registered before the bonus limit, by registration time
+        self.addresses = [address for _, address in entries]
+        self.all_addresses = frozenset(self.addresses)
+        self.settings_addresses = frozenset(to_checksum_address(address)
+                                            for address in settings['bonus_addresses'])
+        self._eligible = {}
+        self._ratios = {}
+
+    def get_eligible(self, reward_time, with_settings_addresses=True):
+        """ Addresses registered before `reward_time` (and the bonus limit) """
+        count = bisect_left(self.times, reward_time)
+        key = (count, with_settings_addresses)
+        if key not in self._eligible:
+            eligible = frozenset(self.addresses[:count])
+            if with_settings_addresses:
+                eligible = eligible | self.settings_addresses
+            self._eligible[key] = eligible
+        return self._eligible[key]
+
+    def get_ratio(self, reward_time):
+        """ Bonus ratio of a round, decreasing linearly over the bonus duration """
+        if reward_time not in self._ratios:
+            ratio = 1
+            if reward_time < self.settings['bonus_limit_ts']:
+                days_since_start = int(reward_time - self.settings['reward_start_ts']) / 86400
+                ratio = 1 + ((self.settings['bonus_ratio']-1)
+                             * (1 - min(1, days_since_start / self.settings['bonus_duration'])))
+            self._ratios[reward_time] = ratio
+        return self._ratios[reward_time]
+
+
+def get_bonus_index(registrations, settings):
+    """ Accept either the raw registrations dict or an already built index """
+    if isinstance(registrations, BonusIndex):
+        return registrations
+    return BonusIndex(registrations, settings)
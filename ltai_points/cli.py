@@ -1,17 +1,21 @@
 """Console script for ltai_points."""
 import asyncio
+from contextlib import ExitStack
+import json
 import logging
-import math
 import sys
 
 import click
 
 from . import __version__
-from .ethereum import get_account, get_token_state, get_web3, mint_tokens
+from .addresses import get_address_cache_info
+from .ethereum import distribute_tokens, get_account, get_token_state, get_web3
 from .ltai_points import compute_points
 from .poster import post_state
+from .profiling import PROFILERS, count, profile, run_report, stage
 from .settings import get_settings
-from .storage import close_dbs, get_dbs
+from .simulation import simulate_distributions
+from .storage import close_dbs, get_dbs, migrate_dbs
 from .supply import get_supply_info
 
 LOGGER = logging.getLogger(__name__)
@@ -33,17 +37,21 @@ async def process(settings, dbs, publish=False, mint=False):
     account = get_account(settings)
 
     web3 = get_web3(settings)
-    previous_mints, balances, last_block_time, last_mint_time, last_distribution_times = await get_token_state(settings, web3)
+    with stage('token_state'):
+        previous_mints, balances, last_block_time, last_mint_time, last_distribution_times = await get_token_state(settings, web3, dbs=dbs)
 
     LOGGER.info(f"Starting as address {account.get_address()}")
-    pools, max_supply, allocations = get_supply_info(settings)
-    points, pending_points, estimated_points, info = await compute_points(settings, dbs, previous_mints,
-                                                                          balances, pools, allocations,
-                                                                          last_mint_time, last_distribution_times)
+    with stage('supply_info'):
+        pools, max_supply, allocations = get_supply_info(settings)
+    with stage('compute_points'):
+        points, pending_points, estimated_points, info = await compute_points(settings, dbs, previous_mints,
+                                                                              balances, pools, allocations,
+                                                                              last_mint_time, last_distribution_times)
     # now we get supply info
     info['last_time'] = last_mint_time
     if publish:
-        await post_state(settings, balances, points, pending_points, estimated_points, info)
+        with stage('post_state'):
+            await post_state(settings, balances, points, pending_points, estimated_points, info)
     if mint:
         to_send = {}
         for address, amount in pending_points.items():
@@ -52,19 +60,10 @@ async def process(settings, dbs, publish=False, mint=False):
 
         print(to_send)
 
-        max_items = settings['ethereum_batch_size']
-
-        distribution_list = list(to_send.items())
-
-        last_nonce = None
-
-        for i in range(math.ceil(len(distribution_list) / max_items)):
-            step_items = distribution_list[max_items * i : max_items * (i + 1)]
-            print(f"doing batch {i} of {len(step_items)} items")
-            tx_hash, last_nonce = await mint_tokens(settings, web3, dict(step_items), nonce=last_nonce)
-            print(tx_hash, last_nonce)
-            last_nonce += 1
-            await asyncio.sleep(settings['pause_time_duration']) # let's wait a bit to avoid spamming the network
+        with stage('mint'):
+            distribution = await distribute_tokens(settings, web3, to_send)
+        count('mint_transactions', distribution['transactions'])
+        print(json.dumps(distribution, indent=2))
 
     return points
 
@@ -72,13 +71,45 @@ async def process(settings, dbs, publish=False, mint=False):
 @click.option('-v', '--verbose', count=True)
 @click.option('-p', '--publish', is_flag=True, help='Publish the results to the aleph network')
 @click.option('-m', '--mint', is_flag=True, help='Mint outstanding tokens')
+@click.option('--migrate-storage', is_flag=True, help='Rewrite the stored entries with the configured codec and exit')
+@click.option('--simulate-mint', default=None, metavar='SIZES',
+              help='Run distributions of these comma separated sizes on a local chain and exit')
+@click.option('--report', 'report_path', default=None, metavar='PATH',
+              help='Write the JSON run report (stage timings and counters) to this file')
+@click.option('--profile', 'profiler', type=click.Choice(PROFILERS), default=None,
+              help='Profile the run')
+@click.option('--profile-output', default=None, metavar='PATH',
+              help='Profile output file (ltai_points.prof or ltai_points.html by default)')
 @click.version_option(version=__version__)
-def main(verbose, publish=False, mint=False, args=None):
+def main(verbose, publish=False, mint=False, migrate_storage=False, simulate_mint=None,
+         report_path=None, profiler=None, profile_output=None, args=None):
     """Console script for ltai_points."""
     setup_logging(verbose)
     settings = get_settings()
+    if simulate_mint:
+        sizes = [int(size) for size in simulate_mint.split(',')]
+        print(json.dumps(asyncio.run(simulate_distributions(settings, sizes)), indent=2))
+        return 0
+
     dbs = get_dbs(settings)
-    asyncio.run(process(settings, dbs, publish, mint))
+    if migrate_storage:
+        asyncio.run(migrate_dbs(dbs))
+    else:
+        with ExitStack() as stack:
+            report = stack.enter_context(run_report())
+            if profiler is not None:
+                if profile_output is None:
+                    profile_output = 'ltai_points.html' if profiler == 'pyinstrument' else 'ltai_points.prof'
+                stack.enter_context(profile(profiler, profile_output))
+            asyncio.run(process(settings, dbs, publish, mint))
+
+        address_cache = get_address_cache_info()
+        report.count('address_cache_hits', address_cache.hits)
+        report.count('address_cache_misses', address_cache.misses)
+        if report_path is not None:
+            with open(report_path, 'w') as f:
+                f.write(report.to_json())
+        LOGGER.info(f"Run report: {report.to_json()}")
     close_dbs(dbs)
     return 0
 
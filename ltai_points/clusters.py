@@ -0,0 +1,92 @@
+""" Address clusters.
+
+Addresses seen together on a node (its owner and its latest reward address)
+belong to the same operator. We keep them in a disjoint-set forest with union by
+size and path halving, so linking and looking up the cluster of an address are
+both amortized near constant time, whatever the length of the chains of links.
+
+Only the latest addresses of each node count: a node seen with new addresses
+replaces its previous ones, and as a forest can't split, it is rebuilt from the
+latest addresses of every node at the next lookup.
+"""
+
+
+class AddressClusters:
+    def __init__(self):
+        self.parents = {}
+        self.members = {}
+        # latest (owner, reward address) of each node
+        self.node_addresses = {}
+        # whether a node replaced its addresses since the forest was built
+        self.stale = False
+
+    def __contains__(self, address):
+        self.rebuild()
+        return address in self.parents
+
+    def __len__(self):
+        self.rebuild()
+        return len(self.members)
+
+    def rebuild(self):
+        """ Build the forest again from the latest addresses of the nodes, if they changed """
+        if not self.stale:
+            return
+        self.parents = {}
+        self.members = {}
+        self.stale = False
+        for node_owner, reward_address in self.node_addresses.values():
+            self.union(node_owner, reward_address)
+
+    def find(self, address):
+        """ Cluster id (root address) of `address`, an unknown address is its own cluster """
+        self.rebuild()
+        parents = self.parents
+        if address not in parents:
+            return address
+        while parents[address] != address:
+            parents[address] = parents[parents[address]]
+            address = parents[address]
+        return address
+
+    def add(self, address):
+        if address not in self.parents:
+            self.parents[address] = address
+            self.members[address] = [address]
+
+    def union(self, address, other):
+        self.rebuild()
+        self.add(address)
+        self.add(other)
+        root, other_root = self.find(address), self.find(other)
+        if root == other_root:
+            return root
+        if len(self.members[root]) < len(self.members[other_root]):
+            root, other_root = other_root, root
+        self.parents[other_root] = root
+        self.members[root].extend(self.members.pop(other_root))
+        return root
+
+    def link(self, node_hash, node_owner, reward_address):
+        addresses = (node_owner, reward_address)
+        previous = self.node_addresses.get(node_hash, None)
+        if previous == addresses:
+            return
+        self.node_addresses[node_hash] = addresses
+        if previous is None and not self.stale:
+            self.union(node_owner, reward_address)
+        else:
+            self.stale = True
+
+    def get_members(self, address):
+        """ All the addresses of the cluster of `address` (itself included) """
+        root = self.find(address)
+        return self.members.get(root, [address])
+
+    def get_totals(self, values):
+        """ Sum of `values` (a dict by address) over each cluster, by cluster id """
+        totals = {}
+        for address, value in values.items():
+            root = self.find(address)
+            totals[root] = totals.get(root, 0) + value
+        return totals
@@ -0,0 +1,30 @@
+""" State of a single points computation.
+
+Everything that accumulates while the rounds are processed (the address
+clusters, the bonus index, the prepared snapshots, the cluster multipliers)
+lives on a RunContext instead of module globals, so several computations can
+run in one process, one after the other or concurrently, without sharing
+anything.
+"""
+from .bonus import get_bonus_index
+from .clusters import AddressClusters
+from .snapshot import SnapshotCache
+
+
+class RunContext:
+    def __init__(self, settings, clusters=None):
+        self.settings = settings
+        self.clusters = AddressClusters() if clusters is None else clusters
+        self.bonus_index = None
+        self.snapshots = SnapshotCache()
+        # reward multiplier by cluster id, once the clusters are complete
+        self.cluster_multipliers = {}
+
+    def get_bonus_index(self, registrations):
+        """ Bonus index of the registrations, built once per run """
+        if self.bonus_index is None or self.bonus_index.registrations is not registrations:
+            self.bonus_index = get_bonus_index(registrations, self.settings)
+        return self.bonus_index
+
+    def link_addresses(self, node_hash, node_owner, reward_address):
+        return self.clusters.link(node_hash, node_owner, reward_address)
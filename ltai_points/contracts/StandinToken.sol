@@ -0,0 +1,61 @@
+// SPDX-License-Identifier: MIT
+pragma solidity ^0.8.20;
+
+/// Stand-in for the LTAI token in the offline mint simulation (see simulation.py).
+///
+/// Only the mint path of the token is reproduced: the two bulk mint entry points,
+/// the owner and minter allowance checks, and for every recipient the pause and
+/// cap checks, the total supply and balance updates and the Transfer event.
+/// simulation.py compiles it with solc (py-solc-x).
+///
+/// Gas compared to the token: the storage reads and writes and the Transfer logs,
+/// about 25k gas per new recipient, and the ABI decoding are the same. This leaves
+/// out the dispatch over the whole token interface and the ERC20 hook calls, which
+/// we estimate at a few hundred gas per recipient, about 1%, well within the
+/// default 20% `ethereum_gas_margin`. The storage layout of the real token
+/// differs, which doesn't change the gas.
+contract StandinToken {
+    event Transfer(address indexed from, address indexed to, uint256 value);
+
+    uint256 public constant CAP = 1_000_000_000 ether;
+
+    mapping(address => uint256) public balanceOf;           // slot 0
+    uint256 public totalSupply;                             // slot 1
+    address public owner;                                   // slot 2
+    bool public paused;                                     // slot 3
+    mapping(address => uint256) public minterAllowances;    // slot 4
+
+    constructor() {
+        owner = msg.sender;
+        minterAllowances[msg.sender] = CAP;
+    }
+
+    function bulkMint(address[] calldata recipients, uint256[] calldata amounts) external {
+        require(recipients.length == amounts.length);
+        uint256 allowance = minterAllowances[msg.sender];
+        for (uint256 i = 0; i < recipients.length; i++) {
+            require(allowance >= amounts[i]);
+            allowance -= amounts[i];
+            _mint(recipients[i], amounts[i]);
+        }
+        minterAllowances[msg.sender] = allowance;
+    }
+
+    function ownerBulkMint(address[] calldata recipients, uint256[] calldata amounts) external {
+        require(msg.sender == owner);
+        require(recipients.length == amounts.length);
+        for (uint256 i = 0; i < recipients.length; i++) {
+            _mint(recipients[i], amounts[i]);
+        }
+    }
+
+    function _mint(address to, uint256 amount) internal {
+        require(!paused);
+        require(to != address(0));
+        uint256 supply = totalSupply + amount;
+        require(supply <= CAP);
+        totalSupply = supply;
+        balanceOf[to] += amount;
+        emit Transfer(address(0), to, amount);
+    }
+}
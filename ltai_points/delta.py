@@ -0,0 +1,93 @@
+""" Structural diffs between consecutive corechannel snapshots.
+
+Lists of dicts identified by a 'hash' (the nodes and resource nodes) are diffed
+item by item, dicts (a node, its stakers) key by key. Anything else is replaced
+as a whole. A diff is a dict with some of:
+
+- 's': keys set to a new value
+- 'u': keys removed
+- 'd': nested dict diffs, by key
+- 'l': keyed list diffs, by key, made of 'a' (added items), 'r' (removed
+  hashes) and 'c' (item diffs by hash)
+
+Applying a diff never mutates the base, unchanged branches are shared.
+"""
+import json
+
+
+def is_keyed_list(value):
+    return (isinstance(value, list) and len(value) > 0
+            and all(isinstance(item, dict) and 'hash' in item for item in value))
+
+
+def diff_keyed_lists(old, new):
+    old_items = {item['hash']: item for item in old}
+    new_hashes = set(item['hash'] for item in new)
+    diff = {}
+    added = [item for item in new if item['hash'] not in old_items]
+    if added:
+        diff['a'] = added
+    removed = [item['hash'] for item in old if item['hash'] not in new_hashes]
+    if removed:
+        diff['r'] = removed
+    changed = {}
+    for item in new:
+        old_item = old_items.get(item['hash'], None)
+        if old_item is not None and old_item != item:
+            changed[item['hash']] = diff_dicts(old_item, item)
+    if changed:
+        diff['c'] = changed
+    return diff
+
+
+def diff_dicts(old, new):
+    diff = {}
+    for key, value in new.items():
+        if key not in old:
+            diff.setdefault('s', {})[key] = value
+        elif old[key] != value:
+            old_value = old[key]
+            if isinstance(old_value, dict) and isinstance(value, dict):
+                diff.setdefault('d', {})[key] = diff_dicts(old_value, value)
+            elif is_keyed_list(old_value) and is_keyed_list(value):
+                diff.setdefault('l', {})[key] = diff_keyed_lists(old_value, value)
+            else:
+                diff.setdefault('s', {})[key] = value
+    removed = [key for key in old if key not in new]
+    if removed:
+        diff['u'] = removed
+    return diff
+
+
+def apply_keyed_list_diff(old, diff):
+    removed = set(diff.get('r', []))
+    changed = diff.get('c', {})
+    items = []
+    for item in old:
+        if item['hash'] in removed:
+            continue
+        if item['hash'] in changed:
+            item = apply_dict_diff(item, changed[item['hash']])
+        items.append(item)
+    items.extend(diff.get('a', []))
+    return items
+
+
+def apply_dict_diff(old, diff):
+    removed = set(diff.get('u', []))
+    new = {key: value for key, value in old.items() if key not in removed}
+    for key, value_diff in diff.get('d', {}).items():
+        new[key] = apply_dict_diff(old[key], value_diff)
+    for key, value_diff in diff.get('l', {}).items():
+        new[key] = apply_keyed_list_diff(old[key], value_diff)
+    new.update(diff.get('s', {}))
+    return new
+
+
+def make_snapshot_diff(old, new):
+    """ Diff from `old` to `new`, or None when the diff would not rebuild `new`
+    exactly (including the order of the keys and items) """
+    diff = diff_dicts(old, new)
+    if json.dumps(apply_dict_diff(old, diff)) != json.dumps(new):
+        return None
+    return diff
@@ -1,8 +1,15 @@
-from functools import lru_cache
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import copy
 import json
+import math
 import os
+import time
 from pathlib import Path
 
+import requests
 import web3
 from web3._utils.events import (
     construct_event_topic_set,
@@ -13,10 +20,20 @@ try:
 except ImportError:
     from web3._utils.events import get_event_data
 
+from web3.exceptions import TransactionNotFound
+try:
+    from web3.exceptions import Web3RPCError
+    RPC_ERRORS = (ValueError, Web3RPCError)
+except ImportError:
+    RPC_ERRORS = (ValueError,)
+
 from aleph.sdk.chains.ethereum import ETHAccount
 from eth_account import Account
 from hexbytes import HexBytes
 
+from .addresses import to_checksum_address
+from .profiling import count
+
 import logging
 LOGGER = logging.getLogger(__name__)
 
@@ -74,9 +91,8 @@ def get_gas_info(web3):
     max_fee_per_gas = (5 * base_fee_per_gas) + max_priority_fee_per_gas # Maximum amount you’re willing to pay 
     return max_fee_per_gas, max_priority_fee_per_gas
 
-async def mint_tokens(settings, web3, targets, nonce=None, owner=False):
+def get_mint_call(settings, web3, targets, owner=False):
     tokens = get_token_contract(settings, web3)
-    account = get_eth_account(settings)
     # now we call bulkMint, that takes two args: an array of addresses and an array of amounts
     # we need to convert the targets dict to two arrays and the amount to 18 decimal places
     addresses = []
@@ -86,31 +102,283 @@ async def mint_tokens(settings, web3, targets, nonce=None, owner=False):
         addresses.append(target)
         amounts.append(int(amount * (10**18)))
 
-    max_fee, max_priority = get_gas_info(web3)
-    
-    if nonce is None:
-        nonce= web3.eth.get_transaction_count(account.address)
-
     fn = tokens.functions.bulkMint
     if owner:
         fn = tokens.functions.ownerBulkMint
 
-    tx = fn(addresses, amounts).build_transaction({
+    return fn(addresses, amounts)
+
+def build_mint_transaction(settings, web3, targets, nonce, max_fee, max_priority, owner=False, gas=12000000):
+    return get_mint_call(settings, web3, targets, owner=owner).build_transaction({
         'chainId': settings['ethereum_chain_id'],
-        'gas': 12000000,
+        'gas': gas,
         'nonce': nonce,
         'maxFeePerGas': max_fee,
         'maxPriorityFeePerGas': max_priority
     })
 
-    signed_tx = account.sign_transaction(tx)
-    tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
-    return tx_hash, nonce
+def estimate_mint_gas(settings, web3, account, targets, owner=False):
+    return get_mint_call(settings, web3, targets, owner=owner).estimate_gas({'from': account.address})
+
+def fit_mint_gas(settings, web3, account, targets, owner=False, sample_size=10):
+    """ Fit the gas used by a mint as `base + per_recipient * recipients`,
+    from the estimates for one recipient and for a sample of them """
+    items = list(targets.items())
+    single = estimate_mint_gas(settings, web3, account, dict(items[:1]), owner=owner)
+    sample_size = min(sample_size, len(items))
+    if sample_size < 2:
+        return single, 0
+    sample = estimate_mint_gas(settings, web3, account, dict(items[:sample_size]), owner=owner)
+    per_recipient = max(0, (sample - single) / (sample_size - 1))
+    return single - per_recipient, per_recipient
+
+def get_mint_batch_size(settings, web3, base_gas, per_recipient_gas, max_size):
+    """ Largest batch filling at most `ethereum_block_gas_fraction` of a block """
+    if per_recipient_gas <= 0:
+        return max_size
+    gas_limit = web3.eth.get_block("latest")['gasLimit']
+    target_gas = gas_limit * settings['ethereum_block_gas_fraction'] / settings['ethereum_gas_margin']
+    return max(1, min(max_size, int((target_gas - base_gas) // per_recipient_gas)))
+
+def get_mint_gas(settings, web3, account, targets, owner=False):
+    """ Gas limit of a built batch: its own estimate, with the margin. The fit can't be
+    used here, the first balance write of a new recipient costs several times the
+    update of an existing one and the sample may only hold existing ones """
+    return int(estimate_mint_gas(settings, web3, account, targets, owner=owner)
+               * settings['ethereum_gas_margin'])
+
+def get_raw_transaction(signed_tx):
+    # renamed in recent eth-account versions
+    return getattr(signed_tx, 'raw_transaction', None) or signed_tx.rawTransaction
+
+def get_transaction_receipt(web3, tx_hashes):
+    """ Receipt of whichever of these transactions (same nonce) got mined """
+    for tx_hash in tx_hashes:
+        try:
+            receipt = web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            continue
+        if receipt is not None:
+            return receipt
+    return None
+
+def sign_mint(account, item):
+    item['signed'] = account.sign_transaction(item['tx'])
+
+def poll_receipt(web3, item, logger=LOGGER):
+    """ Record the receipt of a batch if one of its transactions got mined """
+    try:
+        receipt = get_transaction_receipt(web3, item['hashes'])
+    except RPC_ERRORS as e:
+        # polled again later
+        logger.warning(f"error getting the receipt of batch {item['index']}: {e}")
+        return False
+    if receipt is None:
+        return False
+    item['receipt'] = receipt
+    item['status'] = 'success' if receipt['status'] == 1 else 'failed'
+    logger.info(f"batch {item['index']} mined in block {receipt['blockNumber']}: {item['status']}")
+    return True
+
+def broadcast_mint(web3, item, logger=LOGGER):
+    """ Send the signed transaction of a batch and update its status: pending when
+    it (or the transaction it replaces) waits to be mined, success or failed when its
+    nonce got mined, rejected when nothing was accepted and the nonce is still free """
+    signed_tx = item['signed']
+    try:
+        tx_hash = web3.eth.send_raw_transaction(get_raw_transaction(signed_tx))
+    except RPC_ERRORS as e:
+        message = str(e).lower()
+        if 'already known' in message:
+            tx_hash = signed_tx.hash
+        elif 'nonce too low' in message:
+            # the nonce got mined, by this batch or by another transaction
+            item['hashes'].append(signed_tx.hash)
+            if not poll_receipt(web3, item, logger=logger):
+                logger.error(f"nonce {item['nonce']} of batch {item['index']} was used by another transaction")
+                item['status'] = 'failed'
+                item['error'] = str(e)
+            return
+        elif item['hashes']:
+            # e.g. an underpriced replacement, the transaction we tried to replace
+            # is still pending, keep waiting for it
+            logger.warning(f"replacement of batch {item['index']} refused ({e}), waiting for the previous one")
+            item['sent_at'] = time.monotonic()
+            return
+        else:
+            logger.error(f"error sending batch {item['index']} (nonce {item['nonce']}): {e}")
+            item['status'] = 'rejected'
+            item['error'] = str(e)
+            return
+    item['hashes'].append(tx_hash)
+    item['sent_at'] = time.monotonic()
+    item['status'] = 'pending'
+    logger.info(f"sent batch {item['index']} (nonce {item['nonce']}, {len(item['targets'])} items): {tx_hash.hex()}")
+
+async def distribute_tokens(settings, web3, targets, batch_size=None, owner=False, logger=LOGGER):
+    """ Mint the targets in batches, pipelined.
+
+    Unless given, the batch size is chosen from a fit of the gas used per recipient
+    (capped to `ethereum_batch_size`), and each transaction gets the gas estimated for
+    its own batch.
+    All the batches are built and signed up front with consecutive nonces, then broadcast
+    keeping at most `ethereum_max_in_flight` of them unconfirmed. A batch without receipt
+    after `ethereum_replace_timeout` seconds is replaced with bumped fees.
+
+    Send errors are handled per batch: a batch rejected by the node, or stuck, leaves
+    its nonce free so the following batches are not sent. Returns a distribution report
+    whatever happened to the batches.
+    """
+    account = get_eth_account(settings)
+    started_at = time.monotonic()
+    items = list(targets.items())
+
+    if not items:
+        return get_distribution_report([], 0)
 
-async def get_logs_query(web3, contract,
-                   start_height, end_height, topics,
-                   load_mode='rpc', explorer_api_key=None,
-                   explorer_api_path=None):
+    base_gas, per_recipient_gas = fit_mint_gas(settings, web3, account, targets, owner=owner)
+    if batch_size is None:
+        batch_size = get_mint_batch_size(settings, web3, base_gas, per_recipient_gas,
+                                         settings['ethereum_batch_size'])
+    logger.info(f"mint gas: {base_gas:.0f} + {per_recipient_gas:.0f} per recipient, {batch_size} recipients per batch")
+
+    max_fee, max_priority = get_gas_info(web3)
+    first_nonce = web3.eth.get_transaction_count(account.address, 'pending')
+
+    batches = []
+    for i in range(math.ceil(len(items) / batch_size)):
+        batch_targets = dict(items[batch_size * i : batch_size * (i + 1)])
+        gas = get_mint_gas(settings, web3, account, batch_targets, owner=owner)
+        item = {
+            'index': i,
+            'nonce': first_nonce + i,
+            'targets': batch_targets,
+            'tx': build_mint_transaction(settings, web3, batch_targets, first_nonce + i,
+                                         max_fee, max_priority, owner=owner, gas=gas),
+            'signed': None,
+            'hashes': [],
+            'sent_at': None,
+            'replacements': 0,
+            'receipt': None,
+            'status': 'not_sent',
+            'error': None,
+        }
+        sign_mint(account, item)
+        batches.append(item)
+
+    queue = deque(batches)
+    in_flight = []
+
+    def stop_after(item):
+        # the following nonces can't be mined either: stop sending, and stop
+        # waiting for the batches already sent after this one
+        queue.clear()
+        for other in list(in_flight):
+            if other['nonce'] > item['nonce']:
+                logger.error(f"batch {other['index']} (nonce {other['nonce']}) is stuck after batch {item['index']}")
+                other['status'] = 'stuck'
+                in_flight.remove(other)
+
+    def track(item):
+        if item['status'] == 'pending':
+            if item not in in_flight:
+                in_flight.append(item)
+            return
+        if item in in_flight:
+            in_flight.remove(item)
+        if item['status'] in ('rejected', 'stuck'):
+            stop_after(item)
+
+    while queue or in_flight:
+        while queue and len(in_flight) < settings['ethereum_max_in_flight']:
+            item = queue.popleft()
+            broadcast_mint(web3, item, logger=logger)
+            track(item)
+
+        if not in_flight:
+            continue
+
+        await asyncio.sleep(settings['ethereum_receipt_poll_interval'])
+
+        for item in list(in_flight):
+            if item['status'] != 'pending':
+                # stopped after a previous batch
+                continue
+            if poll_receipt(web3, item, logger=logger):
+                track(item)
+            elif time.monotonic() - item['sent_at'] > settings['ethereum_replace_timeout']:
+                if item['replacements'] >= settings['ethereum_max_replacements']:
+                    logger.error(f"batch {item['index']} (nonce {item['nonce']}) is stuck")
+                    item['status'] = 'stuck'
+                    track(item)
+                    continue
+                # a replacement needs at least 10% higher fees
+                item['tx'] = dict(item['tx'],
+                                  maxFeePerGas=int(item['tx']['maxFeePerGas'] * 1.125) + 1,
+                                  maxPriorityFeePerGas=int(item['tx']['maxPriorityFeePerGas'] * 1.125) + 1)
+                item['replacements'] += 1
+                sign_mint(account, item)
+                broadcast_mint(web3, item, logger=logger)
+                track(item)
+
+    return get_distribution_report(batches, time.monotonic() - started_at)
+
+def get_distribution_report(batches, duration):
+    report_batches = []
+    for item in batches:
+        receipt = item['receipt']
+        report_batches.append({
+            'nonce': item['nonce'],
+            'recipients': len(item['targets']),
+            'amount': sum(item['targets'].values()),
+            'status': item['status'],
+            'tx_hash': item['hashes'][-1].hex() if item['hashes'] else None,
+            'replaced_tx_hashes': [tx_hash.hex() for tx_hash in item['hashes'][:-1]],
+            'block_number': receipt['blockNumber'] if receipt else None,
+            'gas_limit': item['tx']['gas'],
+            'gas_used': receipt['gasUsed'] if receipt else None,
+            'error': item['error'],
+        })
+    return {
+        'transactions': len(report_batches),
+        'recipients': sum(batch['recipients'] for batch in report_batches if batch['status'] == 'success'),
+        'amount': sum(batch['amount'] for batch in report_batches if batch['status'] == 'success'),
+        'gas_used': sum(batch['gas_used'] or 0 for batch in report_batches),
+        'duration': duration,
+        'batches': report_batches,
+    }
+
+# codes and messages of the errors nodes return when a log query covers too many
+# blocks or matches too many logs (geth, erigon, infura, alchemy, quicknode, ankr...)
+RANGE_ERROR_CODES = {-32000, -32005, -32600, -32602}
+RANGE_ERROR_MESSAGES = ['more than', 'block range', 'range is too', 'range too', 'too many blocks',
+                        'too many logs', 'response size', 'limit exceeded', 'too wide', 'too large']
+
+def get_rpc_error(e):
+    """ JSON-RPC error object of a get_logs failure, if any """
+    rpc_response = getattr(e, 'rpc_response', None)
+    if rpc_response and isinstance(rpc_response.get('error', None), dict):
+        return rpc_response['error']
+    if getattr(e, 'args', None) and isinstance(e.args[0], dict):
+        return e.args[0]
+    return {}
+
+def get_rpc_error_code(e):
+    """ JSON-RPC error code of a get_logs failure, if any """
+    return get_rpc_error(e).get('code', None)
+
+def is_range_error(e):
+    """ Server errors returned when a log query covers too much, other errors in the
+    server range (internal errors, rate limits...) are not fixed by a smaller query """
+    error = get_rpc_error(e)
+    message = str(error.get('message', '')).lower()
+    return (error.get('code', None) in RANGE_ERROR_CODES
+            and any(part in message for part in RANGE_ERROR_MESSAGES))
+
+def query_logs(web3, contract,
+               start_height, end_height, topics,
+               load_mode='rpc', explorer_api_key=None,
+               explorer_api_path=None):
     LOGGER.debug(f'getting events for {start_height} to {end_height}')
     if load_mode == 'rpc':
         try:
@@ -118,12 +386,10 @@ async def get_logs_query(web3, contract,
         except AttributeError:
             w3_get_logs = web3.eth.get_logs
 
-        logs = w3_get_logs({'address': contract.address,
-                                'fromBlock': start_height,
-                                'toBlock': end_height,
-                                'topics': topics})
-        for log in logs:
-            yield log
+        return w3_get_logs({'address': contract.address,
+                            'fromBlock': start_height,
+                            'toBlock': end_height,
+                            'topics': topics})
     elif load_mode == 'explorer':
         params = {
             "module": "logs",
@@ -142,58 +408,143 @@ async def get_logs_query(web3, contract,
             explorer_api_path,
             params=params
         )
+        logs = []
         for item in resp.json()['result']:
             item['blockHash'] = None
-            yield log_entry_formatter(item)
-
-
+            logs.append(log_entry_formatter(item))
+        return logs
 
-async def get_logs(web3, contract, start_height, topics=None, load_mode="rpc",
-             explorer_api_key=None, explorer_api_path=None, logger=LOGGER):
+async def get_logs_query(web3, contract,
+                   start_height, end_height, topics,
+                   load_mode='rpc', explorer_api_key=None,
+                   explorer_api_path=None):
+    for log in query_logs(web3, contract, start_height, end_height, topics,
+                          load_mode=load_mode, explorer_api_key=explorer_api_key,
+                          explorer_api_path=explorer_api_path):
+        yield log
+
+async def get_logs_windows(web3, contract, start_height, last_block, topics,
+                           window=2000, concurrency=4, min_window=10, max_window=100000,
+                           target_logs=5000, retries=3, backoff=1, max_buffered=None,
+                           logger=LOGGER, **query_args):
+    """ Fetch the logs of [start_height, last_block] in block windows, several at a time
+    in a thread pool, and yield them in block order.
+
+    The window grows while responses stay small and shrinks when they get big. A window
+    failing because it covers too much is split in two and retried, one failing for
+    another reason is retried with an exponential backoff. At most `max_buffered`
+    windows are kept ahead of the one being waited for, no new window is started
+    while it is stalled.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    if max_buffered is None:
+        max_buffered = concurrency * 4
+    cursor = start_height
+    # (start, end, attempt, delay) of the windows to query before any new one
+    retry_ranges = deque()
+    running = {}
+    results = {}
+    next_height = start_height
+
+    async def query(range_start, range_end, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        return await loop.run_in_executor(executor, partial(query_logs, web3, contract, range_start,
+                                                            range_end, topics, **query_args))
+
+    def schedule():
+        nonlocal cursor
+        while len(running) < concurrency and (
+                retry_ranges or (cursor <= last_block and len(results) < max_buffered)):
+            if retry_ranges:
+                range_start, range_end, attempt, delay = retry_ranges.popleft()
+            else:
+                range_start, range_end, attempt, delay = cursor, min(cursor + window - 1, last_block), 0, 0
+                cursor = range_end + 1
+            future = asyncio.ensure_future(query(range_start, range_end, delay))
+            running[future] = (range_start, range_end, attempt)
+
+    schedule()
     try:
-        logs = get_logs_query(web3, contract,
-                              start_height+1, 'latest', topics=topics,
-                              load_mode=load_mode, explorer_api_key=explorer_api_key,
-                              explorer_api_path=explorer_api_path)
-        async for log in logs:
-            yield log
-    except ValueError as e:
-        # we got an error, let's try the pagination aware version.
-        if (getattr(e, 'args')
-                and len(e.args)
-                and not (-33000 < e.args[0]['code'] <= -32000)):
-            return
-
-        try:
-            last_block = web3.eth.blockNumber
-        except AttributeError:
-            last_block = web3.eth.block_number
-#         if (start_height < config.ethereum.start_height.value):
-#             start_height = config.ethereum.start_height.value
-
-        end_height = start_height + 2000
-
-        while True:
-            try:
-                logs = get_logs_query(web3, contract,
-                                      start_height, end_height, topics=topics,
-                                      load_mode=load_mode)
-                async for log in logs:
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                range_start, range_end, attempt = running.pop(future)
+                try:
+                    logs = future.result()
+                except RPC_ERRORS as e:
+                    if is_range_error(e) and range_start < range_end:
+                        logger.warning(f"Range error getting logs for {range_start}-{range_end}: {e}")
+                        middle = (range_start + range_end) // 2
+                        retry_ranges.extendleft([(middle + 1, range_end, 0, 0), (range_start, middle, 0, 0)])
+                        window = max(min_window, (range_end - range_start + 1) // 2)
+                        continue
+                    if attempt == retries:
+                        raise
+                    delay = backoff * (2 ** attempt)
+                    logger.warning(f"Error getting logs for {range_start}-{range_end} ({e}), "
+                                   f"retrying in {delay}s")
+                    retry_ranges.append((range_start, range_end, attempt + 1, delay))
+                    continue
+
+                results[range_start] = (range_end, logs)
+                if len(logs) > target_logs:
+                    window = max(min_window, window // 2)
+                elif len(logs) < target_logs // 4 and range_end - range_start + 1 >= window:
+                    window = min(max_window, window * 2)
+
+            while next_height in results:
+                range_end, logs = results.pop(next_height)
+                for log in logs:
                     yield log
+                next_height = range_end + 1
 
-                start_height = end_height + 1
-                end_height = start_height + 2000
+            schedule()
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
 
-                if start_height > last_block:
-                    logger.info("Ending big batch sync")
-                    break
+async def get_logs(web3, contract, start_height, topics=None, load_mode="rpc",
+             explorer_api_key=None, explorer_api_path=None, logger=LOGGER,
+             window=2000, concurrency=4, retries=3, backoff=1):
+    for attempt in range(retries + 1):
+        try:
+            logs = [log async for log in get_logs_query(
+                web3, contract, start_height+1, 'latest', topics=topics,
+                load_mode=load_mode, explorer_api_key=explorer_api_key,
+                explorer_api_path=explorer_api_path)]
+        except RPC_ERRORS as e:
+            # only a query covering too much is worth the pagination aware version,
+            # the others are retried and the caller must not checkpoint a sync that
+            # missed logs
+            if is_range_error(e):
+                break
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            logger.warning(f"Error getting logs ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+        else:
+            for log in logs:
+                yield log
+            return
 
-            except ValueError as e:
-                LOGGER.error(f"Error getting logs: {e}")
-                if -33000 < e.args[0]['code'] <= -32000:
-                    end_height = start_height + 200
-                else:
-                    raise
+    try:
+        last_block = web3.eth.blockNumber
+    except AttributeError:
+        last_block = web3.eth.block_number
+
+    # logs are fetched after start_height, as in the first query
+    logs = get_logs_windows(web3, contract, start_height + 1, last_block, topics,
+                            window=window, concurrency=concurrency, retries=retries,
+                            backoff=backoff, logger=logger,
+                            load_mode=load_mode, explorer_api_key=explorer_api_key,
+                            explorer_api_path=explorer_api_path)
+    async for log in logs:
+        yield log
+    logger.info("Ending big batch sync")
 
 async def lookup_timestamp(web3, block_number, block_timestamps):
     if block_number in block_timestamps:
@@ -202,61 +553,206 @@ async def lookup_timestamp(web3, block_number, block_timestamps):
     block_timestamps[block_number] = block.timestamp
     return block.timestamp
 
+def get_blocks(web3, block_numbers):
+    """ Get several blocks in one JSON-RPC batch request when the provider supports it """
+    if hasattr(web3, 'batch_requests'):
+        try:
+            with web3.batch_requests() as batch:
+                for block_number in block_numbers:
+                    batch.add(web3.eth.get_block(block_number))
+                return batch.execute()
+        except TypeError:
+            # batch requests are not supported by this provider
+            pass
+    return [web3.eth.get_block(block_number) for block_number in block_numbers]
+
+def get_block_timestamps_db(settings, dbs):
+    return dbs['block_timestamps'].namespace(str(settings['ethereum_chain_id']))
+
+async def lookup_timestamps(web3, block_numbers, block_timestamps, cache_db=None, batch_size=100):
+    """ Timestamps of several blocks, from the in-memory dict, then the persistent
+    cache, then batched block requests for the remaining ones """
+    missing = sorted(set(block_number for block_number in block_numbers
+                         if block_number not in block_timestamps))
+    if cache_db is not None:
+        still_missing = []
+        for block_number in missing:
+            timestamp = await cache_db.get_entry(f'{block_number:012d}')
+            if timestamp is None:
+                still_missing.append(block_number)
+            else:
+                block_timestamps[block_number] = timestamp
+        count('block_timestamps_cached', len(missing) - len(still_missing))
+        missing = still_missing
+
+    count('block_timestamps_fetched', len(missing))
+    for i in range(0, len(missing), batch_size):
+        batch_numbers = missing[i:i + batch_size]
+        LOGGER.debug(f"fetching {len(batch_numbers)} block timestamps")
+        for block_number, block in zip(batch_numbers, get_blocks(web3, batch_numbers)):
+            block_timestamps[block_number] = block['timestamp']
+            if cache_db is not None:
+                await cache_db.store_entry(f'{block_number:012d}', block['timestamp'])
+
+    return {block_number: block_timestamps[block_number] for block_number in block_numbers}
+
+
+TRANSFER_INPUTS = [('from', 'address', True), ('to', 'address', True), ('value', 'uint256', False)]
+
+def is_erc20_transfer_abi(abi):
+    """ Whether an event ABI is the standard Transfer(address,address,uint256) """
+    return (abi.get('name') == 'Transfer'
+            and not abi.get('anonymous', False)
+            and [(item['name'], item['type'], item['indexed']) for item in abi['inputs']] == TRANSFER_INPUTS)
+
+def to_raw_bytes(value):
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+    return bytes(value)
+
+def decode_transfer_log(log):
+    """ Decode a Transfer log straight from its topics and data, with the same
+    fields as get_event_data """
+    topics = log['topics']
+    return {
+        'args': {
+            'from': to_checksum_address('0x' + to_raw_bytes(topics[1])[-20:].hex()),
+            'to': to_checksum_address('0x' + to_raw_bytes(topics[2])[-20:].hex()),
+            'value': int.from_bytes(to_raw_bytes(log['data']), 'big'),
+        },
+        'event': 'Transfer',
+        'logIndex': log['logIndex'],
+        'transactionIndex': log['transactionIndex'],
+        'transactionHash': log['transactionHash'],
+        'address': log['address'],
+        'blockHash': log['blockHash'],
+        'blockNumber': log['blockNumber'],
+    }
 
-async def get_token_state(settings, web3, logger=LOGGER, load_mode='rpc'):
-    tokens = get_token_contract(settings, web3)
-    abi = tokens.events.Transfer._get_event_abi()
-
-    topic = construct_event_topic_set(abi, web3.codec)
-    mints = {}
-    balances = {}
-    last_height = settings['ethereum_min_height']
-    last_mint_height = settings['ethereum_min_height']
-    last_distribution_blocks = {}
+def get_transfer_decoder(web3, abi):
+    """ Fast decoder for the standard Transfer layout, web3's generic one otherwise """
+    if is_erc20_transfer_abi(abi):
+        return decode_transfer_log
+    return partial(get_event_data, web3.codec, abi)
+
+def get_empty_token_state(settings):
+    return {
+        'mints': {},
+        'balances': {},
+        'last_distribution_blocks': {},
+        'last_height': settings['ethereum_min_height'],
+        'last_mint_height': settings['ethereum_min_height'],
+        # all the transfers up to this block are folded in the state
+        'synced_height': settings['ethereum_min_height'],
+    }
 
-    async for i in get_logs(web3, tokens, settings['ethereum_min_height'], topics=topic,
-                            load_mode=load_mode, logger=logger):
-        evt_data = get_event_data(web3.codec, abi, i)
+def apply_transfer(state, evt_data):
+    """ Fold a decoded Transfer event in the token state """
+    mints = state['mints']
+    balances = state['balances']
+    last_distribution_blocks = state['last_distribution_blocks']
 
-        tx_hash = evt_data['transactionHash'].hex()
+    tx_detail = evt_data['args']
 
-        tx_detail = evt_data['args']
+    amount = tx_detail['value'] / (10**18)
 
-        amount = tx_detail['value'] / (10**18)
+    if tx_detail['from'] != ZERO_ADDRESS:
+        balances[tx_detail['from']] = balances.get(tx_detail['from'], 0) - amount
+    else:
+        mints[tx_detail['to']] = mints.get(tx_detail['to'], 0) + amount
+        if evt_data['logIndex'] > 5 and evt_data['blockNumber'] > state['last_mint_height']: # we have a bulk mint
+            state['last_mint_height'] = evt_data['blockNumber']
+        if last_distribution_blocks.get(tx_detail['to'], 0) < evt_data['blockNumber']:
+            last_distribution_blocks[tx_detail['to']] = evt_data['blockNumber']
+
+    balances[tx_detail['to']] = balances.get(tx_detail['to'], 0) + amount
+
+    if evt_data['blockNumber'] > state['last_height']:
+        state['last_height'] = evt_data['blockNumber']
+
+def get_token_state_db(settings, dbs):
+    return dbs['token_state'].namespace(
+        f"{settings['ethereum_chain_id']}-{settings['ethereum_token_contract'].lower()}")
+
+async def load_token_state(settings, state_db):
+    """ Last stored checkpoint of the token state """
+    last_key = await state_db.get_last_available_key()
+    if last_key is not None:
+        async for _, state in state_db.retrieve_entries(start_key=last_key):
+            return state
+    return get_empty_token_state(settings)
+
+async def store_token_state(state_db, state):
+    """ Checkpoint the token state, keyed by its synced block, and drop the older ones """
+    key = f"{state['synced_height']:012d}"
+    previous_keys = [previous_key async for previous_key in state_db.retrieve_keys()
+                     if previous_key < key]
+    await state_db.store_entry(key, state)
+    for previous_key in previous_keys:
+        await state_db.delete_entry(previous_key)
+
+async def get_token_state(settings, web3, logger=LOGGER, load_mode='rpc', dbs=None):
+    tokens = get_token_contract(settings, web3)
+    abi = tokens.events.Transfer._get_event_abi()
 
+    topic = construct_event_topic_set(abi, web3.codec)
 
-        if tx_detail['from'] != ZERO_ADDRESS:
-            balances[tx_detail['from']] = balances.get(tx_detail['from'], 0) - amount
+    state_db = None
+    state = get_empty_token_state(settings)
+    if dbs is not None:
+        state_db = get_token_state_db(settings, dbs)
+        state = await load_token_state(settings, state_db)
+    start_height = state['synced_height']
+
+    # transfers in the last blocks could still be reorged, we only fold them
+    # into the returned state and not in the stored one
+    safe_height = web3.eth.block_number - settings['ethereum_reorg_margin']
+    unsafe_events = []
+    decode_log = get_transfer_decoder(web3, abi)
+    decoded = 0
+
+    async for i in get_logs(web3, tokens, start_height, topics=topic,
+                            load_mode=load_mode, logger=logger,
+                            window=settings['ethereum_log_window'],
+                            concurrency=settings['ethereum_log_concurrency'],
+                            retries=settings['ethereum_log_retries']):
+        evt_data = decode_log(i)
+        decoded += 1
+
+        if evt_data['blockNumber'] <= safe_height:
+            apply_transfer(state, evt_data)
         else:
-            mints[tx_detail['to']] = mints.get(tx_detail['to'], 0) + amount
-            if evt_data['logIndex'] > 5 and evt_data['blockNumber'] > last_mint_height: # we have a bulk mint
-                last_mint_height = evt_data['blockNumber']
-            if last_distribution_blocks.get(tx_detail['to'], 0) < evt_data['blockNumber']:
-                last_distribution_blocks[tx_detail['to']] = evt_data['blockNumber']
-        
-        balances[tx_detail['to']] = balances.get(tx_detail['to'], 0) + amount
-
-
-        # address = tx_detail['to']
-        # amount = tx_detail['value'] / (10**18)
-        # mints[address] = mints.get(address, 0) + amount
-
-        if evt_data['blockNumber'] > last_height:
-            last_height = evt_data['blockNumber']
-    
-    # our block timestamps cache
-    block_timestamps = {}
-    # get last block timestamp
-    last_block_timestamp = await lookup_timestamp(web3, last_height, block_timestamps)
-    last_mint_timestamp = await lookup_timestamp(web3, last_mint_height, block_timestamps)
+            unsafe_events.append(evt_data)
+
+    count('transfer_logs_decoded', decoded)
+
+    if safe_height > start_height:
+        state['synced_height'] = safe_height
+        if state_db is not None:
+            await store_token_state(state_db, state)
+
+    if unsafe_events:
+        state = copy.deepcopy(state)
+        for evt_data in unsafe_events:
+            apply_transfer(state, evt_data)
+
+    # our block timestamps cache, most distributions share the blocks of a few bulk mints
+    cache_db = None
+    if dbs is not None:
+        cache_db = get_block_timestamps_db(settings, dbs)
+    block_timestamps = await lookup_timestamps(
+        web3, [state['last_height'], state['last_mint_height'], *state['last_distribution_blocks'].values()],
+        {}, cache_db=cache_db)
+    last_block_timestamp = block_timestamps[state['last_height']]
+    last_mint_timestamp = block_timestamps[state['last_mint_height']]
     last_distribution_times = {
-        address: await lookup_timestamp(web3, block, block_timestamps)
-        for address, block in last_distribution_blocks.items()
+        address: block_timestamps[block]
+        for address, block in state['last_distribution_blocks'].items()
     }
 
 
     
-    return mints, balances, last_block_timestamp, last_mint_timestamp, last_distribution_times
+    return state['mints'], state['balances'], last_block_timestamp, last_mint_timestamp, last_distribution_times
 
 
 
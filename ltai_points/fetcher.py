@@ -1,119 +1,210 @@
+import asyncio
 import logging
 import math
 import pprint
+from collections import deque
+from itertools import islice
 from datetime import date, datetime, timezone
 
+import aiohttp
 from aleph.sdk.client import AlephHttpClient
 from aleph.sdk.query.filters import MessageFilter, PostFilter
 from aleph_message.models import MessageType
 
+from .addresses import to_checksum_address
+from .profiling import count
+
 LOGGER = logging.getLogger(__name__)
 
-async def fetch_posts(client, filter, per_page=20):
+async def fetch_concurrently(fetch_item, keys, concurrency=4, retries=3, backoff=1):
+    """ Call `fetch_item` for each key with at most `concurrency` requests in flight,
+    retrying failed requests with an exponential backoff. Results are yielded in key order. """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(key):
+        async with semaphore:
+            for attempt in range(retries + 1):
+                try:
+                    result = await fetch_item(key)
+                    count('api_requests')
+                    return result
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == retries:
+                        raise
+                    delay = backoff * (2 ** attempt)
+                    LOGGER.warning(f"error fetching {key} ({e}), retrying in {delay}s")
+                    await asyncio.sleep(delay)
+
+    keys = iter(keys)
+    # only keep a bounded number of results ahead of the consumer
+    scheduled = deque()
+    for key in islice(keys, concurrency * 2):
+        scheduled.append((key, asyncio.ensure_future(fetch(key))))
+
+    try:
+        while scheduled:
+            key, task = scheduled.popleft()
+            result = await task
+            next_key = next(keys, None)
+            if next_key is not None:
+                scheduled.append((next_key, asyncio.ensure_future(fetch(next_key))))
+            yield key, result
+    finally:
+        for _, task in scheduled:
+            task.cancel()
+
+async def fetch_pages(fetch_page, target_pages, concurrency=4, retries=3):
+    """ Fetch pages 2..target_pages concurrently, yielded in page order """
+    async for page, result in fetch_concurrently(fetch_page, range(2, target_pages+1),
+                                                 concurrency=concurrency, retries=retries):
+        LOGGER.debug(f"processing page {page}/{target_pages}")
+        yield result
+
+async def fetch_posts(client, filter, per_page=20, concurrency=4, retries=3):
     posts = await client.get_posts(
         post_filter=filter,
         page_size=per_page
     )
+    count('api_requests')
     target_pages = math.ceil(posts.pagination_total / posts.pagination_per_page)
 
-    for page in range(2, target_pages+1):
-
-        for post in posts.posts:
-            yield post
+    for post in posts.posts:
+        yield post
 
-        LOGGER.debug(f"processing page {page}/{target_pages}")
-        posts = await client.get_posts(
+    async def fetch_page(page):
+        return await client.get_posts(
             post_filter=filter,
             page=page,
             page_size=per_page
         )
 
-    for post in posts.posts:
-        yield post
+    async for posts in fetch_pages(fetch_page, target_pages, concurrency=concurrency, retries=retries):
+        for post in posts.posts:
+            yield post
 
-async def fetch_messages(client, filter, per_page=20):
+async def fetch_messages(client, filter, per_page=20, concurrency=4, retries=3):
     messages = await client.get_messages(
         message_filter=filter,
         page_size=per_page
     )
+    count('api_requests')
     target_pages = math.ceil(messages.pagination_total / messages.pagination_per_page)
     print(messages.pagination_total, messages.pagination_per_page, target_pages)
-    if target_pages > 1:
-        for page in range(2, target_pages+1):
-
-            for message in messages.messages:
-                yield message
-
-            LOGGER.debug(f"processing page {page}/{target_pages}")
-            messages = await client.get_messages(
-                message_filter=filter,
-                page=page,
-                page_size=per_page
-            )
-
-            print('page', page, '/', target_pages)
 
     for message in messages.messages:
         yield message
 
-async def fetch_sampled_messages(client, filter, per_day=12, splits=4):
-    # we get the stat_date of the filter
-    start_date = filter.start_date
-    now = datetime.now(timezone.utc).timestamp()
-    # we get the number of days between the start and now
-    days = (now - start_date) / 86400
-    # we get the first batch to get the pagination info
-    messages = await client.get_messages(
-        message_filter=filter,
-        page_size=per_day
-    )
-
-    per_day = int(per_day / splits)
-
-    # we get the number of messages per day
-    messages_per_day = messages.pagination_total / days
+    async def fetch_page(page):
+        return await client.get_messages(
+            message_filter=filter,
+            page=page,
+            page_size=per_page
+        )
 
-    # we get the number of pages total
-    target_pages = math.ceil(messages.pagination_total / per_day)
-    last_date = None
+    async for messages in fetch_pages(fetch_page, target_pages, concurrency=concurrency, retries=retries):
+        for message in messages.messages:
+            yield message
+
+async def fetch_bucketed_messages(client, buckets, interval=86400,
+                                  concurrency=4, retries=3, **filter_args):
+    """ Issue one narrow query per `interval` bucket starting at each of `buckets`
+    and yield the latest matching message of each bucket, in bucket order.
+    Empty buckets are skipped. """
+
+    async def fetch_bucket(bucket_start):
+        return await client.get_messages(
+            message_filter=MessageFilter(start_date=bucket_start,
+                                         end_date=bucket_start + interval,
+                                         **filter_args),
+            page_size=1
+        )
 
-    if target_pages > 1:
-        for page in range(2, target_pages+1):
-            # should we skip this page as we already got something that day?
-            # we process twice per day anyway, just in case
-            if page % (int(messages_per_day/per_day)/splits):
-                continue
+    async for bucket_start, messages in fetch_concurrently(fetch_bucket, buckets,
+                                                           concurrency=concurrency, retries=retries):
+        for message in messages.messages:
+            yield message
+
+def get_snapshot_bucket(settings, timestamp):
+    """ Start of the snapshot bucket of `timestamp`, aligned on UTC days for a one day interval """
+    interval = settings['snapshot_interval']
+    return int(timestamp // interval) * interval
+
+def get_bucket_date(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+
+async def get_missing_buckets(settings, db, end_time):
+    """ Snapshot buckets from the start of the rewards to `end_time` without any stored
+    snapshot. Buckets nothing was published in stay missing, and are queried again.
+
+    The snapshots are stored by date, so the interval has to be a whole number of days.
+    """
+    if settings['snapshot_interval'] <= 0 or settings['snapshot_interval'] % 86400:
+        raise ValueError(f"The snapshot interval must be a whole number of days, "
+                         f"got {settings['snapshot_interval']} seconds")
+    first_bucket = get_snapshot_bucket(settings, settings['reward_start_ts'])
+    stored_buckets = set()
+    async for key in db.retrieve_keys(start_key=get_bucket_date(first_bucket),
+                                      end_key=get_bucket_date(end_time)):
+        key_time = datetime.fromisoformat(key).replace(tzinfo=timezone.utc).timestamp()
+        stored_buckets.add(get_snapshot_bucket(settings, key_time))
+    return [bucket for bucket in range(first_bucket, int(end_time) + 1, settings['snapshot_interval'])
+            if bucket not in stored_buckets]
+
+def fetch_corechannel_messages(client, settings, buckets):
+    return fetch_bucketed_messages(client, buckets,
+                                   interval=settings['snapshot_interval'],
+                                   concurrency=settings['api_page_concurrency'],
+                                   retries=settings['api_page_retries'],
+                                   channels=["FOUNDATION"],
+                                   message_types=[MessageType.aggregate],
+                                   content_keys=["corechannel"],
+                                   addresses=[settings['aleph_corechannel_sender']])
+
+async def next_or_none(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def get_snapshots(settings, db, prepare_content, start_key=None):
+    """ Stored (date, snapshot) entries from `start_key` on, merged in date order with
+    the corechannel messages of the missing days, which are fetched and stored. The
+    fetched days are all yielded, even before `start_key`: they weren't seen yet """
+    missing_buckets = await get_missing_buckets(settings, db, datetime.now(timezone.utc).timestamp())
+    stored = db.retrieve_entries(start_key=start_key)
+    if not missing_buckets:
+        async for key, values in stored:
+            yield key, values
+        return
 
-            for message in messages.messages:
-                if message.time.date() == last_date:
+    async with AlephHttpClient(api_server=settings['api_endpoint']) as client:
+        async def fetch_missing():
+            seen_dates = set()
+            async for message in fetch_corechannel_messages(client, settings, missing_buckets):
+                if message.content.key != "corechannel":
                     continue
-
-                yield message
-                last_date = message.time.date()
-                print(message.time.date())
-
-            messages = await client.get_messages(
-                message_filter=filter,
-                page=page,
-                page_size=per_day
-            )
-            print('page', page, '/', target_pages)
-
-    for message in messages.messages:
-        if message.time.date() == last_date:
-            continue
-
-        yield message
-        last_date = message.time.date()
-
-
-
-    target_pages = math.ceil(messages.pagination_total / messages.pagination_per_page)
-    # we get the total number of messages
-    total_messages = messages.pagination_total
-    # we get the number of messages to get
-    messages_to_get = int(messages_per_day * days)
-
+                message_date = message.time.date().isoformat()
+                if message_date in seen_dates:
+                    continue
+                seen_dates.add(message_date)
+
+                values = prepare_content(message.content.content)
+                await db.store_entry(message_date, values)
+                yield message_date, values
+
+        fetched = fetch_missing()
+        fetched_entry = await next_or_none(fetched)
+        async for key, values in stored:
+            while fetched_entry is not None and fetched_entry[0] < key:
+                yield fetched_entry
+                fetched_entry = await next_or_none(fetched)
+            if fetched_entry is not None and fetched_entry[0] == key:
+                # a day stored since the missing days were listed
+                fetched_entry = await next_or_none(fetched)
+            yield key, values
+        while fetched_entry is not None:
+            yield fetched_entry
+            fetched_entry = await next_or_none(fetched)
 
 async def get_pending_rewards(settings):
     # we only get one post, the last one
@@ -127,77 +218,23 @@ async def get_pending_rewards(settings):
         )
         return posts.posts[0].content['rewards'], posts.posts[0].time
 
+def compute_message_totals(content):
+    message_totals = {}
+    for node in content['nodes']:
+        node_address = node.get('reward', node['owner'])
+        message_totals[node_address] = message_totals.get(node_address, 0) + 200000
+        for address, amount in node['stakers'].items():
+            message_totals[address] = message_totals.get(address, 0) + amount
+    return message_totals
+
 async def get_staked_amounts(settings, dbs):
-    staked_db = dbs['staked_amounts']
-    last_date = await staked_db.get_last_available_key()
-    print(last_date)
-    if last_date is None:
-        last_date = settings['reward_start_ts']
-    else:
-        last_date = datetime.fromisoformat(last_date).timestamp()
-        print(last_date)
-
-    seen_dates = set()
-
-    async for key, values in staked_db.retrieve_entries():
+    async for key, values in get_snapshots(settings, dbs['staked_amounts'], compute_message_totals):
         yield key, values
-        seen_dates.add(key)
-
-    async with AlephHttpClient(api_server=settings['api_endpoint']) as client:
-        messages = fetch_sampled_messages(client,
-                                  filter=MessageFilter(channels=["FOUNDATION"],
-                                                       message_types=[MessageType.aggregate],
-                                                       addresses=[settings['aleph_corechannel_sender']],
-                                                       start_date=float(last_date)),
-                                  per_day=10)
-
-        async for message in messages:
-            if message.content.key == "corechannel":
-                message_totals = {}
-                message_date = message.time.date().isoformat()
-                if message_date in seen_dates:
-                    continue
-
-                for node in message.content.content['nodes']:
-                    node_address = node.get('reward', node['owner'])
-                    message_totals[node_address] = message_totals.get(node_address, 0) + 200000
-                    for address, amount in node['stakers'].items():
-                        message_totals[address] = message_totals.get(address, 0) + amount
 
-                yield (message_date, message_totals)
-                await staked_db.store_entry(message_date, message_totals)
-
-async def get_corechanel_statuses(settings, dbs):
-    corechanel_db = dbs['corechannel_status']
-    last_date = await corechanel_db.get_last_available_key()
-    print(last_date)
-    if last_date is None:
-        last_date = settings['reward_start_ts']
-    else:
-        last_date = datetime.fromisoformat(last_date).timestamp()
-        print(last_date)
-
-    seen_dates = set()
-
-    async for key, values in corechanel_db.retrieve_entries():
+async def get_corechanel_statuses(settings, dbs, start_key=None):
+    async for key, values in get_snapshots(settings, dbs['corechannel_status'], lambda content: content,
+                                           start_key=start_key):
         yield key, values
-        seen_dates.add(key)
-
-    async with AlephHttpClient(api_server=settings['api_endpoint']) as client:
-        messages = fetch_sampled_messages(client,
-                                  filter=MessageFilter(channels=["FOUNDATION"],
-                                                       message_types=[MessageType.aggregate],
-                                                       addresses=[settings['aleph_corechannel_sender']],
-                                                       start_date=float(last_date)))
-
-        async for message in messages:
-            if message.content.key == "corechannel":
-                message_date = message.time.date().isoformat()
-                if message_date in seen_dates:
-                    continue
-
-                yield (message_date, message.content.content)
-                await corechanel_db.store_entry(message_date, message.content.content)
 
 async def get_aleph_rewards(settings):
     async with AlephHttpClient(api_server=settings['api_endpoint']) as client:
@@ -206,7 +243,9 @@ async def get_aleph_rewards(settings):
                                               addresses=[settings['aleph_reward_sender']],
                                               tags=['distribution'],
                                               types=['staking-rewards-distribution']),
-                            per_page=50)
+                            per_page=50,
+                            concurrency=settings['api_page_concurrency'],
+                            retries=settings['api_page_retries'])
 
         async for post in posts:
             if 'mainnet' not in post.content['tags']:
@@ -235,18 +274,21 @@ async def get_account_registrations(settings):
                                   filter=MessageFilter(channels=["LIBERTAI"],
                                                        message_types=[MessageType.aggregate],
                                                        end_date=settings['bonus_limit_ts']),
-                                  per_page=1000)
+                                  per_page=1000,
+                                  concurrency=settings['api_page_concurrency'],
+                                  retries=settings['api_page_retries'])
 
         async for message in messages:
             if message.content.key == "libertai" and message.content.content.get('registered', False):
-                if message.sender not in registrations:
-                    registrations[message.sender] = message.time.timestamp()
-                    counts[message.sender] = 1
+                sender = to_checksum_address(message.sender)
+                if sender not in registrations:
+                    registrations[sender] = message.time.timestamp()
+                    counts[sender] = 1
                 else:
                     # check if the message date is before the current registration date
-                    if message.time.timestamp() < registrations[message.sender]:
-                        registrations[message.sender] = message.time.timestamp()
-                    counts[message.sender] += 1
+                    if message.time.timestamp() < registrations[sender]:
+                        registrations[sender] = message.time.timestamp()
+                    counts[sender] += 1
 
                 print(f"user {message.sender} registered at {message.time}")
     return registrations, counts
@@ -0,0 +1,70 @@
+""" Persisted per-day points ledger.
+
+Completed days never change once their corechannel snapshot is known, so we
+store the per-address points of each day (and the node address links seen that
+day) and only compute the days without an entry. A day backfilled after later
+days got computed is such a day, whatever its date.
+
+Entries are scoped by a hash of every input that changes the result of a daily
+round, so changing the settings (or the registrations) starts a fresh ledger.
+"""
+import hashlib
+import json
+
+# settings that have an impact on the result of process_virtual_daily_round
+LEDGER_SETTINGS_KEYS = [
+    'reward_start_ts',
+    'staked_ratio',
+    'aleph_reward_ratio',
+    'aleph_reward_stakers_daily_base',
+    'aleph_reward_nodes_daily_base',
+    'aleph_reward_resource_node_monthly_base',
+    'aleph_reward_resource_node_monthly_variable',
+    'aleph_node_max_paid',
+    'daily_decay',
+    'bonus_ratio',
+    'bonus_duration',
+    'bonus_limit_ts',
+    'bonus_addresses',
+]
+
+
+def get_ledger_key(settings, registrations):
+    """ Hash of the round inputs, used to namespace the ledger entries """
+    payload = json.dumps({
+        'settings': {key: settings[key] for key in LEDGER_SETTINGS_KEYS},
+        'registrations': registrations,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def get_ledger(settings, dbs, registrations):
+    return dbs['points_ledger'].namespace(get_ledger_key(settings, registrations))
+
+
+async def get_ledger_entries(ledger, end_key):
+    """ Yield the stored days strictly before `end_key` as
+    (date, totals, links) """
+    async for key, entry in ledger.retrieve_entries(end_key=end_key):
+        if key == end_key:
+            break
+        yield key, entry['totals'], entry['links']
+
+
+async def get_replay_end(ledger, snapshots_db, end_key):
+    """ First stored snapshot date before `end_key` without a ledger entry,
+    `end_key` when the ledger covers all of them """
+    ledger_dates = set()
+    async for key in ledger.retrieve_keys(end_key=end_key):
+        ledger_dates.add(key)
+    async for key in snapshots_db.retrieve_keys(end_key=end_key):
+        if key != end_key and key not in ledger_dates:
+            return key
+    return end_key
+
+
+async def store_ledger_entry(ledger, ddate, totals, links):
+    await ledger.store_entry(ddate, {
+        'totals': totals,
+        'links': links,
+    })
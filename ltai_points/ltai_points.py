@@ -1,11 +1,16 @@
 """Main module."""
-from .fetcher import get_account_registrations, get_aleph_rewards, get_pending_rewards, get_staked_amounts, get_corechanel_statuses
+from .fetcher import get_account_registrations, get_aleph_rewards, get_pending_rewards, get_staked_amounts, get_corechanel_statuses, next_or_none
 from .supply import get_instant_allocs, get_supply_info, get_linear_allocs
+from .ledger import get_ledger, get_ledger_entries, get_replay_end, store_ledger_entry
+from .addresses import get_address_cache_info, to_checksum_address
+from .bonus import get_bonus_index
+from .context import RunContext
+from .profiling import count, stage
+from .sinks import get_output_sink, write_points
+from .snapshot import compute_staked_amounts, get_prepared_snapshot
 from datetime import datetime, timezone, timedelta
 from .ethereum import get_web3
-import pprint
 import math
-import web3
 
 def compute_score_multiplier(score: float) -> float:
     """
@@ -38,9 +43,6 @@ def compute_reward_multiplier(ratio: float) -> float:
     else:
         return 1
     
-linked_addresses = dict()
-address_identifiers = dict()
-nodes_addresses = dict()
     
 async def get_address_reward_multiplier(address: str, previous_mints: dict, 
                                   balances: dict) -> float:
@@ -52,15 +54,20 @@ async def get_address_reward_multiplier(address: str, previous_mints: dict,
         return 1
     return compute_reward_multiplier(balances[address] / previous_mints[address])
 
-async def get_address_cluster_reward_multiplier(address: str, previous_mints: dict,
-                                                balances: dict):
-    """ use linked_addresses to get the reward multiplier for any address of a cluster (we add all balances together) """
-    linked_addresses = get_linked_addresses(address)
-    total_balance = sum([balances[addr] for addr in linked_addresses if addr in balances])
-    total_minted = sum([previous_mints[addr] for addr in linked_addresses if addr in previous_mints])
-    if total_minted < 100:
-        return 1
-    return compute_reward_multiplier(total_balance / total_minted)
+def get_cluster_reward_multipliers(clusters, previous_mints: dict, balances: dict) -> dict:
+    """ Reward multiplier of each address cluster (we add all balances together), by cluster id.
+    Clusters that minted less than 100 tokens are left out, their multiplier is 1 """
+    total_balances = clusters.get_totals(balances)
+    total_mints = clusters.get_totals(previous_mints)
+    multipliers = {}
+    for cluster, total_minted in total_mints.items():
+        if total_minted >= 100:
+            multipliers[cluster] = compute_reward_multiplier(total_balances.get(cluster, 0) / total_minted)
+    return multipliers
+
+def get_address_cluster_reward_multiplier(context, address: str) -> float:
+    """ reward multiplier of the cluster of an address, from the multipliers of the run """
+    return context.cluster_multipliers.get(context.clusters.find(address), 1)
 
 async def process_round(reward_round, reward_time, totals, registrations, settings):
     ratio = settings['aleph_reward_ratio']
@@ -77,8 +84,7 @@ async def process_round(reward_round, reward_time, totals, registrations, settin
         distribution_bonus_ratio = bonus_ratio * (1 - min(1, days_since_start / settings['bonus_duration']))
 
     # now check which addresses should have the bonus for this round (only if they registered before the bonus limit, and before this distribution)
-    bonus_addresses = [address for address, registration_time in registrations.items()
-                        if registration_time < reward_time and registration_time < settings['bonus_limit_ts']]
+    bonus_addresses = get_bonus_index(registrations, settings).get_eligible(reward_time, with_settings_addresses=False)
     round_total = 0
     round_rewards = 0
     for address, value in reward_round.items():
@@ -95,17 +101,7 @@ async def process_round(reward_round, reward_time, totals, registrations, settin
     print(f"Round total: {round_total}, rewards: {round_rewards}, decay: {decay}, distribution ratio: {distribution_ratio}")
 
 async def get_staked_amounts(status):
-    message_totals = {}
-
-    for node in status['nodes']:
-        reward_address = node.get('reward', None)
-        if reward_address is None or not reward_address:
-            reward_address = node['owner']
-        message_totals[reward_address] = message_totals.get(reward_address, 0) + 200000
-        for address, amount in node['stakers'].items():
-            message_totals[address] = message_totals.get(address, 0) + amount
-
-    return message_totals
+    return compute_staked_amounts(status)
 
 def compute_score_multiplier(score: float) -> float:
     """
@@ -122,53 +118,32 @@ def compute_score_multiplier(score: float) -> float:
         assert 0.2 <= score <= 0.8
         return (score - 0.2) / 0.6
 
-async def link_addresses(node_hash, node_owner, reward_address):
+def link_addresses(context, links, node_hash, node_owner, reward_address):
     """ We try to find cheaters who move their rewards to a different address
-    to game the system """
-    if node_hash not in linked_addresses:
-        nodes_addresses[node_hash] = set()
-    nodes_addresses[node_hash].add(reward_address)
-    nodes_addresses[node_hash].add(node_owner)
-    return nodes_addresses[node_hash]
-
-async def process_address_links():
-    """ populate linked_addresses based on the nodes addresses """
-    for node_hash, addresses in nodes_addresses.items():
-        for address in addresses:
-            if address not in linked_addresses:
-                linked_addresses[address] = set()
-            linked_addresses[address].update(addresses)
-    
-    for i in range(2):
-        for key, values in list(linked_addresses.items()):
-            if key not in values:
-                values.add(key)
-            for value in values:
-                if value not in linked_addresses:
-                    linked_addresses[value] = set()
-                linked_addresses[value].update(values)
-
-def get_linked_addresses(address):
+    to game the system. The link goes to the run clusters and to the `links`
+    record, when given """
+    if context is not None:
+        context.link_addresses(node_hash, node_owner, reward_address)
+    if links is not None:
+        links.append((node_hash, node_owner, reward_address))
+
+def get_linked_addresses(context, address):
     """ we need to find all addresses linked to one in any of the node """
-    if address not in linked_addresses:
-        return set([address])
-    
-    linked_addresses[address].add(address)
-    return linked_addresses[address]
+    return context.clusters.get_members(address)
 
 
-async def process_virtual_daily_round(round_date, status, totals, registrations, settings, day_ratio=1):
-    w3 = web3.Web3()
+async def process_virtual_daily_round(round_date, status, totals, registrations, settings, day_ratio=1, links=None,
+                                      context=None):
     ratio = settings['staked_ratio']
     distrib_ratio = settings['aleph_reward_ratio']
-    bonus_ratio = settings['bonus_ratio']
     reward_time = datetime.fromisoformat(round_date).replace(tzinfo=timezone.utc).timestamp()
     days_since_start = int(reward_time - settings['reward_start_ts']) / 86400
     stakers_daily_base = settings['aleph_reward_stakers_daily_base']
     nodes_daily_base = settings['aleph_reward_nodes_daily_base']
 
-    active_nodes = [node for node in status['nodes'] if node["status"] == "active"]
-    resource_nodes = {rnode['hash']: rnode for rnode in status['resource_nodes']}
+    snapshot = get_prepared_snapshot(status, context)
+    active_nodes = snapshot.active_nodes
+    resource_nodes = snapshot.resource_nodes
     per_day_stakers = (
             (math.log10(len(active_nodes)) + 1) / 3
         ) * stakers_daily_base
@@ -180,9 +155,7 @@ async def process_virtual_daily_round(round_date, status, totals, registrations,
     daily_ltai = daily_base * decay * ratio
     distrib_decayed_ratio = distrib_ratio * decay
 
-    staked_amounts = await get_staked_amounts(status)
-
-    total_staked = sum(staked_amounts.values())
+    total_staked = snapshot.total_staked
     ltai_ratio = daily_ltai / total_staked
 
     def compute_resource_node_rewards(decentralization_factor):
@@ -197,18 +170,13 @@ async def process_virtual_daily_round(round_date, status, totals, registrations,
             / (365/12)
         )
 
-    distribution_bonus_ratio = 1
-    settings_bonus_addresses = settings['bonus_addresses']
-    bonus_addresses = [address for address, registration_time in registrations.items()
-                        if registration_time < reward_time and registration_time < settings['bonus_limit_ts']]
-    # add the settings bonus addresses
-    bonus_addresses += settings_bonus_addresses
-    bonus_addresses = [w3.to_checksum_address(address) for address in bonus_addresses]
-    if reward_time < settings['bonus_limit_ts']:
-        distribution_bonus_ratio = 1 + ((bonus_ratio-1) * (1 - min(1, days_since_start / settings['bonus_duration'])))
-    
+    # registrations can be passed already indexed by the caller
+    bonus_index = get_bonus_index(registrations, settings)
+    bonus_addresses = bonus_index.get_eligible(reward_time)
+    distribution_bonus_ratio = bonus_index.get_ratio(reward_time)
+
     def increment_address_amount(address, amount):
-        address = w3.to_checksum_address(address)
+        """ `address` is already checksummed (by the prepared snapshot) """
         if address not in totals:
             totals[address] = 0
         reward = amount
@@ -216,12 +184,11 @@ async def process_virtual_daily_round(round_date, status, totals, registrations,
             reward *= distribution_bonus_ratio
         totals[address] += reward * day_ratio
     
-    for address, value in staked_amounts.items():
-        if address:
-            increment_address_amount(address, value * ltai_ratio)
+    for address, value in snapshot.staked_rewards:
+        increment_address_amount(address, value * ltai_ratio)
 
-    for node in active_nodes:
-        reward_address = node["owner"]
+    for node, (reward_address, reward_checksum), stakers in zip(active_nodes, snapshot.node_rewards,
+                                                               snapshot.node_stakers):
         this_node = per_node
 
         rnodes = node["resource_nodes"]
@@ -233,14 +200,6 @@ async def process_virtual_daily_round(round_date, status, totals, registrations,
             if rnode["status"] != "linked": # how could this happen?
                 continue
 
-            rnode_reward_address = rnode["owner"]
-            try:
-                rtaddress = w3.to_checksum_address(rnode.get("reward", None))
-                if rtaddress:
-                    rnode_reward_address = rtaddress
-            except Exception:
-                print("Bad reward address, defaulting to owner")
-
             crn_multiplier = compute_score_multiplier(rnode["score"])
 
             assert 0 <= crn_multiplier <= 1, "Invalid value of the score multiplier"
@@ -254,8 +213,9 @@ async def process_virtual_daily_round(round_date, status, totals, registrations,
                 paid_node_count += 1
             
             if paid_node_count <= settings['aleph_node_max_paid']: # we only pay the first N nodes
-                await link_addresses(rnode["hash"], rnode["owner"], rnode_reward_address)
-                increment_address_amount(rnode_reward_address, this_resource_node*distrib_decayed_ratio)
+                rnode_reward_address, rnode_reward_checksum = snapshot.get_rnode_reward(rnode)
+                link_addresses(context, links, rnode["hash"], rnode["owner"], rnode_reward_address)
+                increment_address_amount(rnode_reward_checksum, this_resource_node*distrib_decayed_ratio)
 
         if paid_node_count > settings['aleph_node_max_paid']:
             paid_node_count = settings['aleph_node_max_paid']
@@ -274,42 +234,77 @@ async def process_virtual_daily_round(round_date, status, totals, registrations,
 
         this_node = this_node * this_node_modifier
 
-        try:
-            taddress = w3.to_checksum_address(node.get("reward", None))
-            if taddress:
-                reward_address = taddress
-        except Exception:
-            print("Bad reward address, defaulting to owner")
-
-        await link_addresses(node["hash"], node["owner"], reward_address)
-        increment_address_amount(reward_address, this_node*distrib_decayed_ratio)
+        link_addresses(context, links, node["hash"], node["owner"], reward_address)
+        increment_address_amount(reward_checksum, this_node*distrib_decayed_ratio)
 
-        for addr, value in node["stakers"].items():
+        for addr, value in stakers:
             sreward = ((value / total_staked) * per_day_stakers) * this_node_modifier
             increment_address_amount(addr, sreward*distrib_decayed_ratio)
 
     # print(daily_ltai)
     # print(round_date, sum(staked_amounts.values()))
 
-async def compute_points(settings, dbs, previous_mints, balances, pools, allocations, last_distribution_time, last_distribution_times):
-    w3 = web3.Web3()
+async def process_estimated_rounds(start_date, status, totals, registrations, settings, days, context=None):
+    """ Estimate the points of `days` daily rounds of the same status, starting at `start_date`.
+
+    Only the decay and the bonus ratio change from one of these rounds to the next, so we
+    evaluate the status once without them and apply the geometric decay series analytically.
+    The bonus is summed day by day, but only over the days left in the bonus window.
+    """
+    bonus_index = get_bonus_index(registrations, settings)
+    base_totals = {}
+    await process_virtual_daily_round(start_date, status, base_totals, {},
+                                      dict(settings, daily_decay=1, bonus_ratio=1), context=context)
+
+    start_time = datetime.fromisoformat(start_date).replace(tzinfo=timezone.utc).timestamp()
+    days_since_start = int(start_time - settings['reward_start_ts']) / 86400
+    daily_decay = settings['daily_decay']
+    if daily_decay == 1:
+        decay_sum = days
+    else:
+        decay_sum = daily_decay ** days_since_start * (1 - daily_decay ** days) / (1 - daily_decay)
+
+    # extra bonus points of each address, in decayed days
+    bonus_extras = {}
+    for i in range(days):
+        reward_time = start_time + i * 86400
+        if reward_time >= settings['bonus_limit_ts']:
+            break
+        day_extra = (daily_decay ** (days_since_start + i)) * (bonus_index.get_ratio(reward_time) - 1)
+        for address in bonus_index.get_eligible(reward_time):
+            bonus_extras[address] = bonus_extras.get(address, 0) + day_extra
+
+    for address, value in base_totals.items():
+        totals[address] = totals.get(address, 0) + value * (decay_sum + bonus_extras.get(address, 0))
+
+def accumulate_rewards(rewards, accumulators):
+    """ Add the rewards of a round to each of the (points, scale) accumulators """
+    for points, scale in accumulators:
+        for address, value in rewards.items():
+            points[address] = points.get(address, 0) + value * scale
+
+async def compute_points(settings, dbs, previous_mints, balances, pools, allocations, last_distribution_time,
+                         last_distribution_times, context=None):
+    if context is None:
+        context = RunContext(settings)
     ratio = settings['aleph_reward_ratio']
     bonus_ratio = settings['bonus_ratio']
     totals = {}
     pending_totals = {}
 
-    registrations, counts = await get_account_registrations(settings)
+    with stage('registrations'):
+        registrations, counts = await get_account_registrations(settings)
     print(f"Found {len(registrations)} registrations")
             
-    settings_bonus_addresses = [w3.to_checksum_address(address) for address in settings['bonus_addresses']]
+    settings_bonus_addresses = [to_checksum_address(address) for address in settings['bonus_addresses']]
     for address in settings_bonus_addresses:
         if address not in totals:
             totals[address] = 1000
     
-    all_bonus_addresses = [address for address, registration_time in registrations.items()
-                           if registration_time < settings['bonus_limit_ts']]
+    bonus_index = context.get_bonus_index(registrations)
+    all_bonus_addresses = bonus_index.all_addresses
     
-    for address in all_bonus_addresses:
+    for address in bonus_index.addresses:
         if address not in totals:
             totals[address] = 10
             
@@ -322,13 +317,39 @@ async def compute_points(settings, dbs, previous_mints, balances, pools, allocat
     today_date = datetime.now(timezone.utc).date()
     today = today_date.isoformat()
 
+    # completed days are replayed from the ledger instead of being recomputed, the
+    # snapshots are read from the first day it misses, or for the pending rewards
+    # since the last distribution
+    ledger = get_ledger(settings, dbs, registrations)
+    start_key = await get_replay_end(ledger, dbs['corechannel_status'], last_distribution_date)
+    ledger_entries = get_ledger_entries(ledger, today)
+    ledger_entry = await next_or_none(ledger_entries)
+
+    async def replay_until(ddate):
+        """ Replay the ledger entries up to `ddate` (included, when given) in date order,
+        returns whether `ddate` had one """
+        nonlocal ledger_entry
+        while ledger_entry is not None and (ddate is None or ledger_entry[0] <= ddate):
+            entry_date, day_totals, links = ledger_entry
+            for node_hash, node_owner, reward_address in links:
+                context.link_addresses(node_hash, node_owner, reward_address)
+            for address, value in day_totals.items():
+                totals[address] = totals.get(address, 0) + value
+            count('ledger_days_replayed')
+            ledger_entry = await next_or_none(ledger_entries)
+            if entry_date == ddate:
+                return True
+        return False
+
     today_status = None
-    async for ddate, status in get_corechanel_statuses(settings, dbs):
-        
-        dtotals = totals
-        # if ddate >= pending_date:
-        #     dtotals = pending_totals
-            
+    async for ddate, status in get_corechanel_statuses(settings, dbs, start_key=start_key):
+        in_ledger = await replay_until(ddate)
+        if in_ledger and ddate < last_distribution_date:
+            continue
+
+        # (points, scale) the rewards of this day are added to
+        accumulators = []
+
         # if ddate == today:
         #     today_status = status
         #     continue
@@ -344,35 +365,54 @@ async def compute_points(settings, dbs, previous_mints, balances, pools, allocat
                 ttime = datetime.fromisoformat(today).replace(tzinfo=timezone.utc).timestamp()
 
             pending_ratio = (now.timestamp() - ttime) / 86400
-            await process_virtual_daily_round(today, status, pending_totals, registrations, settings, day_ratio=pending_ratio)
+            accumulators.append((pending_totals, pending_ratio))
 
         elif ddate == last_distribution_date:
             # on distribution day, pending ratio is time from distribution till midnight
             pending_ratio = (last_distribution_datetime.replace(hour=23, minute=59, second=59).timestamp() - last_distribution_time) / 86400
-            await process_virtual_daily_round(today, status, pending_totals, registrations, settings, day_ratio=pending_ratio)
+            # this one is evaluated as a round of today, it can't share the evaluation of the day
+            await process_virtual_daily_round(today, status, pending_totals, bonus_index, settings,
+                                              day_ratio=pending_ratio, context=context)
 
         elif ddate > last_distribution_date:
-            await process_virtual_daily_round(ddate, status, pending_totals, registrations, settings)
+            accumulators.append((pending_totals, 1))
         
         # in all cases add to totals
-        await process_virtual_daily_round(ddate, status, totals, registrations, settings)
-
-
-    # we process the address clusters now
-    await process_address_links()
+        rewards = None
+        if not in_ledger:
+            if ddate < today:
+                # this day is complete, checkpoint it in the ledger
+                rewards = {}
+                links = []
+                await process_virtual_daily_round(ddate, status, rewards, bonus_index, settings, links=links,
+                                                  context=context)
+                await store_ledger_entry(ledger, ddate, rewards, links)
+                count('days_computed')
+            accumulators.append((totals, 1))
+
+        if accumulators:
+            # the snapshot is evaluated once, then added to the totals and pending points
+            if rewards is None:
+                rewards = {}
+                await process_virtual_daily_round(ddate, status, rewards, bonus_index, settings, context=context)
+            accumulate_rewards(rewards, accumulators)
+    await replay_until(None)
 
     total_airdrop = sum(totals.values())
     pools['airdrop']['distributed'] = total_airdrop
 
+    # the clusters are complete now, their multipliers are computed once for the pending and estimated rewards
+    context.cluster_multipliers = get_cluster_reward_multipliers(context.clusters, previous_mints, balances)
+
     # we apply the modifier to the rewards before adding the linear allocs
     for address in pending_totals:
-        reward_multiplier = await get_address_cluster_reward_multiplier(address, previous_mints, balances)
+        reward_multiplier = get_address_cluster_reward_multiplier(context, address)
         pending_totals[address] *= reward_multiplier
 
     # first handle the linear allocs from the beginning
     linear_allocs = get_linear_allocs(settings, allocations, now, pools=pools)
     for address, value in linear_allocs.items():
-        addr = w3.to_checksum_address(address)
+        addr = to_checksum_address(address)
         if addr not in totals:
             totals[addr] = 0
         totals[addr] += value
@@ -384,7 +424,7 @@ async def compute_points(settings, dbs, previous_mints, balances, pools, allocat
     # now we handle them since last distribution for pendings
     linear_allocs = get_linear_allocs(settings, allocations, now, start_time=last_distribution_datetime)
     for address, value in linear_allocs.items():
-        addr = w3.to_checksum_address(address)
+        addr = to_checksum_address(address)
         if addr not in pending_totals:
             pending_totals[addr] = 0
 
@@ -393,7 +433,7 @@ async def compute_points(settings, dbs, previous_mints, balances, pools, allocat
 
     instant_allocs = get_instant_allocs(allocations, pools)
     for address, value in instant_allocs.items():
-        addr = w3.to_checksum_address(address)
+        addr = to_checksum_address(address)
         if addr not in totals:
             totals[addr] = 0
         totals[addr] += value
@@ -402,46 +442,51 @@ async def compute_points(settings, dbs, previous_mints, balances, pools, allocat
             # first mint, let's give it it's instant alloc
             pending_totals[addr] = pending_totals.get(addr, 0) + value
 
-    # let's create an estimate of rewards over the next 36 months based on just today if everyone stays the same
+    # let's create an estimate of rewards over the next months based on just today if everyone stays the same
+    estimate_days = settings['estimate_days']
     estimates_totals = {}
     if today_status is not None:
-        for i in range(365*3):
-            day = (today_date + timedelta(days=i)).isoformat()
-            await process_virtual_daily_round(day, today_status, estimates_totals, registrations, settings)
-        # apply the reward multiplier
-        for address in estimates_totals:
-            reward_multiplier = await get_address_cluster_reward_multiplier(address, previous_mints, balances)
-            estimates_totals[address] *= reward_multiplier
+        with stage('estimates'):
+            if settings['estimate_mode'] == 'simulate':
+                for i in range(estimate_days):
+                    day = (today_date + timedelta(days=i)).isoformat()
+                    await process_virtual_daily_round(day, today_status, estimates_totals, bonus_index, settings,
+                                                      context=context)
+            else:
+                await process_estimated_rounds(today, today_status, estimates_totals, bonus_index, settings,
+                                               estimate_days, context=context)
+            # apply the reward multiplier
+            for address in estimates_totals:
+                reward_multiplier = get_address_cluster_reward_multiplier(context, address)
+                estimates_totals[address] *= reward_multiplier
 
     # now add the linear allocs to the estimate totals
-    estimates_date = (today_date + timedelta(days=365*3)).isoformat()
+    estimates_date = (today_date + timedelta(days=estimate_days)).isoformat()
     linear_allocs = get_linear_allocs(settings, allocations, estimates_date)
     for address, value in linear_allocs.items():
         if address not in estimates_totals:
             estimates_totals[address] = 0
         estimates_totals[address] += value
     
-    pprint.pprint({
-        address: (value, address in all_bonus_addresses) for address, value in totals.items()
-    })
-    pprint.pprint({
-        address: value for address, value in pending_totals.items()
-    })
-
-    # now let's print the count of addresses that have the bonus compared to the ones that don't
-    bonus_count = len([address for address in totals if address in all_bonus_addresses])
-    total_count = len(totals)
-    print(f"Total addresses: {total_count}, bonus addresses: {bonus_count}, ratio: {bonus_count/total_count}")
-    # now print the reward total
-    print(f"Total rewards: {sum(totals.values())}")
-    print(f"Total pending: {sum(pending_totals.values())}")
+    # the points (with the count of addresses that have the bonus) go to the configured sink
+    with stage('output'):
+        sink = get_output_sink(settings)
+        try:
+            write_points(sink, totals, pending_totals, all_bonus_addresses)
+        finally:
+            sink.close()
+    address_cache = get_address_cache_info()
+    print(f"Address checksum cache: {address_cache.hits} hits, {address_cache.misses} misses")
+    count('addresses', len(totals))
+    count('pending_addresses', len(pending_totals))
+    count('address_clusters', len(context.clusters))
     
     info = {
         "ratio": ratio,
         "reward_start": settings['reward_start_ts'],
         "daily_decay": settings['daily_decay'],
         "total_rewards": sum(totals.values()),
-        "boosted_addresses": all_bonus_addresses,
+        "boosted_addresses": bonus_index.addresses,
         "pools": pools
     }
     
@@ -0,0 +1,113 @@
+""" Run instrumentation.
+
+A RunReport collects the wall and CPU time of each stage of a run and a few
+counters (logs decoded, API requests, days replayed...). The report of the
+current run is held in a context variable, so any module can `count()` without
+the report being passed around, and concurrent runs each get their own.
+Nothing is recorded when no report is active.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import cProfile
+import json
+import time
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+PROFILERS = ['cprofile', 'pyinstrument']
+
+current_report = ContextVar('current_report', default=None)
+
+
+class RunReport:
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.stages = {}
+        self.counters = {}
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        """ Time a stage, the times of a stage entered several times add up """
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall': 0, 'cpu': 0, 'calls': 0})
+            stage['wall'] += time.perf_counter() - start_wall
+            stage['cpu'] += time.process_time() - start_cpu
+            stage['calls'] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        return {
+            'started_at': self.started_at.isoformat(),
+            'wall': time.perf_counter() - self._start_wall,
+            'cpu': time.process_time() - self._start_cpu,
+            'stages': self.stages,
+            'counters': self.counters,
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+
+@contextmanager
+def run_report(report=None):
+    """ Make `report` (or a new one) the report of the current run """
+    if report is None:
+        report = RunReport()
+    token = current_report.set(report)
+    try:
+        yield report
+    finally:
+        current_report.reset(token)
+
+
+@contextmanager
+def stage(name):
+    report = current_report.get()
+    if report is None:
+        yield
+        return
+    with report.stage(name):
+        yield
+
+
+def count(name, value=1):
+    report = current_report.get()
+    if report is not None:
+        report.count(name, value)
+
+
+@contextmanager
+def profile(profiler, output_path):
+    """ Profile the block with cProfile (pstats dump) or pyinstrument (html) """
+    if profiler == 'cprofile':
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+        try:
+            yield
+        finally:
+            cprofile.disable()
+            cprofile.dump_stats(output_path)
+    elif profiler == 'pyinstrument':
+        if pyinstrument is None:
+            raise ImportError("The pyinstrument profiler requires the pyinstrument package")
+        instrument = pyinstrument.Profiler(async_mode='enabled')
+        instrument.start()
+        try:
+            yield
+        finally:
+            instrument.stop()
+            with open(output_path, 'w') as f:
+                f.write(instrument.output_html())
+    else:
+        raise ValueError(f"Unknown profiler {profiler}, use one of {', '.join(PROFILERS)}")
@@ -6,9 +6,19 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def get_estimated_aggregate_key(estimate_days):
+    """ Aggregate of the estimated points, named after their horizon """
+    if estimate_days % 365 == 0:
+        return f'estimated_{estimate_days // 365}yr_tokens'
+    return f'estimated_{estimate_days}d_tokens'
+
 def get_settings():
+    estimate_days = int(os.environ.get('ESTIMATE_DAYS', 365*3))
     return {
         'api_endpoint': os.environ.get('API_ENDPOINT', 'https://api2.aleph.im'),
+        'api_page_concurrency': int(os.environ.get('API_PAGE_CONCURRENCY', '4')),  # pages fetched in parallel
+        'api_page_retries': int(os.environ.get('API_PAGE_RETRIES', '3')),
+        'snapshot_interval': int(os.environ.get('SNAPSHOT_INTERVAL', 86400)),  # seconds between sampled corechannel snapshots
         'aleph_reward_sender': os.environ.get('ALEPH_REWARD_SENDER', '0x3a5CC6aBd06B601f4654035d125F9DD2FC992C25'),
         'aleph_calculation_sender': os.environ.get('ALEPH_CALCULATION_SENDER', '0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10'),
         'aleph_corechannel_sender': os.environ.get('ALEPH_CORECHANNEL_SENDER', '0xa1B3bb7d2332383D96b7796B908fB7f7F3c2Be10'),
@@ -24,7 +34,17 @@ def get_settings():
         'ethereum_chain_id': int(os.environ.get('ETHEREUM_CHAIN_ID', '8453')),
         'ethereum_min_height': int(os.environ.get('ETHEREUM_MIN_HEIGHT', '15961530')),
         'ethereum_token_contract': os.environ.get('ETHEREUM_TOKEN_CONTRACT', '0xF8B1b47AA748F5C7b5D0e80C726a843913EB573a'),
-        'ethereum_batch_size': int(os.environ.get('ETHEREUM_BATCH_SIZE', '400')),
+        'ethereum_batch_size': int(os.environ.get('ETHEREUM_BATCH_SIZE', '400')),  # max recipients per mint
+        'ethereum_block_gas_fraction': float(os.environ.get('ETHEREUM_BLOCK_GAS_FRACTION', '0.25')),  # gas target of a mint batch
+        'ethereum_gas_margin': float(os.environ.get('ETHEREUM_GAS_MARGIN', '1.2')),  # over the estimated gas
+        'ethereum_max_in_flight': int(os.environ.get('ETHEREUM_MAX_IN_FLIGHT', '4')),  # unconfirmed mint transactions
+        'ethereum_receipt_poll_interval': float(os.environ.get('ETHEREUM_RECEIPT_POLL_INTERVAL', '2')),
+        'ethereum_replace_timeout': float(os.environ.get('ETHEREUM_REPLACE_TIMEOUT', '120')),  # seconds before bumping the fees
+        'ethereum_max_replacements': int(os.environ.get('ETHEREUM_MAX_REPLACEMENTS', '3')),
+        'ethereum_log_window': int(os.environ.get('ETHEREUM_LOG_WINDOW', '2000')),  # initial blocks per log query
+        'ethereum_log_concurrency': int(os.environ.get('ETHEREUM_LOG_CONCURRENCY', '4')),
+        'ethereum_log_retries': int(os.environ.get('ETHEREUM_LOG_RETRIES', '3')),
+        'ethereum_reorg_margin': int(os.environ.get('ETHEREUM_REORG_MARGIN', '200')),  # blocks not yet trusted by the token state
         'aleph_reward_ratio': float(os.environ.get('ALEPH_REWARD_RATIO', '0.35')),
         'daily_decay': float(os.environ.get('DAILY_DECAY', '0.99722')),
         'bonus_ratio': float(os.environ.get('BONUS_RATIO', '1.5')),
@@ -38,9 +58,16 @@ def get_settings():
         'balances_aggregate_key': os.environ.get('BALANCES_AGGREGATE_KEY', 'tokens'),
         'aggregate_key': os.environ.get('AGGREGATE_KEY', 'minted_tokens'),
         'pending_aggregate_key': os.environ.get('PENDING_AGGREGATE_KEY', 'pending_tokens'),
-        'estimated_aggregate_key': os.environ.get('ESTIMATED_AGGREGATE_KEY', 'estimated_3yr_tokens'),
+        'estimated_aggregate_key': os.environ.get('ESTIMATED_AGGREGATE_KEY',
+                                                  get_estimated_aggregate_key(estimate_days)),
         'db_path': os.environ.get('DB_PATH', './database'),
+        'storage_codec': os.environ.get('STORAGE_CODEC', 'json'),  # json, msgpack or msgpack+zstd
+        'corechannel_storage': os.environ.get('CORECHANNEL_STORAGE', 'full'),  # full or delta
+        'keyframe_interval': int(os.environ.get('KEYFRAME_INTERVAL', '30')),  # entries between two full snapshots
         'bonus_addresses': os.environ.get('BONUS_ADDRESSES', '').split(','),  # list of addresses to receive the bonus,
         'supply_filename': os.environ.get('SUPPLY_FILENAME', 'supply.yaml'),
-        'pause_time_duration': os.environ.get('PAUSE_TIME_DURATION', 5),
+        'estimate_days': estimate_days,  # horizon of the estimated points
+        'estimate_mode': os.environ.get('ESTIMATE_MODE', 'closed_form'),  # closed_form or simulate
+        'output_sink': os.environ.get('OUTPUT_SINK', 'summary'),  # none, summary, stream, csv or jsonl
+        'output_path': os.environ.get('OUTPUT_PATH', None),  # file of the csv and jsonl sinks
     }
@@ -0,0 +1,126 @@
+""" Offline mint simulation.
+
+Runs the bulkMint distribution flow against an in-process EVM (eth-tester with
+py-evm), then syncs the token state back from the Transfer logs.
+
+We don't ship the bytecode of the token contract, so a stand-in contract is
+deployed at the token address: contracts/StandinToken.sol, compiled with solc
+through py-solc-x (which downloads the compiler the first time). It has the mint
+path of the token (bulkMint / ownerBulkMint, the owner, minter allowance, pause
+and cap checks, the supply and balance updates and a Transfer from the zero
+address for every recipient), so the fitted gas is close to that of the token
+(see the contract for the difference).
+"""
+import functools
+import logging
+import os
+import random
+import time
+
+from .ethereum import distribute_tokens, get_token_state
+
+try:
+    from eth_tester import EthereumTester, PyEVMBackend
+    from web3 import Web3, EthereumTesterProvider
+except ImportError:
+    EthereumTester = None
+
+try:
+    import solcx
+except ImportError:
+    solcx = None
+
+LOGGER = logging.getLogger(__name__)
+
+STANDIN_SOURCE = os.path.join(os.path.dirname(__file__), 'contracts', 'StandinToken.sol')
+SOLC_VERSION = '0.8.20'
+STANDIN_CAP = 10**9 * 10**18
+
+# storage slots of StandinToken.sol
+BALANCES_SLOT = 0x00
+TOTAL_SUPPLY_SLOT = 0x01
+OWNER_SLOT = 0x02
+PAUSED_SLOT = 0x03
+MINTER_ALLOWANCES_SLOT = 0x04
+
+
+@functools.lru_cache(maxsize=None)
+def compile_standin_token():
+    """ solc output of StandinToken.sol, with its 'abi', 'bin' and 'bin-runtime' """
+    if solcx is None:
+        raise ImportError("The mint simulation requires the py-solc-x package")
+    if SOLC_VERSION not in [str(version) for version in solcx.get_installed_solc_versions()]:
+        solcx.install_solc(SOLC_VERSION)
+    compiled = solcx.compile_files([STANDIN_SOURCE], output_values=['abi', 'bin', 'bin-runtime'],
+                                   solc_version=SOLC_VERSION)
+    return next(output for name, output in compiled.items() if name.endswith(':StandinToken'))
+
+
+def get_simulation_chain():
+    """ Fresh in-process chain, returns the web3 instance and the funded private key """
+    if EthereumTester is None:
+        raise ImportError("The mint simulation requires the eth-tester[py-evm] package")
+    web3 = Web3(EthereumTesterProvider(EthereumTester(PyEVMBackend())))
+    pkey = web3.provider.ethereum_tester.backend.account_keys[0]
+    return web3, pkey
+
+
+def deploy_standin_token(web3, account_address):
+    tx_hash = web3.eth.send_transaction({
+        'from': account_address,
+        'data': '0x' + compile_standin_token()['bin'],
+    })
+    return web3.eth.wait_for_transaction_receipt(tx_hash)['contractAddress']
+
+
+def get_simulation_targets(size, seed=0):
+    rng = random.Random(seed)
+    return {
+        Web3.to_checksum_address(rng.randbytes(20)): round(rng.uniform(0.1, 1000), 6)
+        for _ in range(size)
+    }
+
+
+def get_simulation(settings):
+    """ Fresh chain with the stand-in token deployed, returns the web3 instance
+    and the settings to mint on it """
+    web3, pkey = get_simulation_chain()
+    address = web3.eth.accounts[0]
+    return web3, dict(settings,
+                      ethereum_pkey=pkey.to_hex(),
+                      ethereum_chain_id=web3.eth.chain_id,
+                      ethereum_token_contract=deploy_standin_token(web3, address),
+                      ethereum_min_height=0,
+                      ethereum_reorg_margin=0,
+                      ethereum_receipt_poll_interval=0)
+
+
+async def simulate_distribution(settings, size, batch_size=None, seed=0, logger=LOGGER):
+    """ Mint to `size` random recipients on a fresh chain, then check the synced
+    token state holds the minted amounts """
+    web3, settings = get_simulation(settings)
+    targets = get_simulation_targets(size, seed=seed)
+
+    report = await distribute_tokens(settings, web3, targets, batch_size=batch_size, logger=logger)
+
+    start = time.monotonic()
+    mints, balances, *_ = await get_token_state(settings, web3, logger=logger)
+    sync_duration = time.monotonic() - start
+
+    mismatches = sum(1 for target, amount in targets.items()
+                     if abs(balances.get(target, 0) - amount) > 1e-9)
+    return {
+        'recipients': size,
+        'transactions': report['transactions'],
+        'batch_size': max(batch['recipients'] for batch in report['batches']),
+        'gas_used': report['gas_used'],
+        'gas_per_recipient': report['gas_used'] / size,
+        'duration': report['duration'],
+        'sync_duration': sync_duration,
+        'mismatches': mismatches,
+    }
+
+
+async def simulate_distributions(settings, sizes, batch_size=None, logger=LOGGER):
+    return [await simulate_distribution(settings, size, batch_size=batch_size, logger=logger)
+            for size in sizes]
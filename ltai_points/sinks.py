@@ -0,0 +1,118 @@
+""" Output sinks for the computed points.
+
+compute_points hands every (section, address, points) row to the sink configured
+in the settings, one at a time, so nothing is formatted (or even iterated) that
+the sink doesn't need:
+
+- none: nothing at all
+- summary: only the address counts and totals
+- stream: the summary, and one tab separated line per row on stdout
+- csv / jsonl: the summary, and the rows written to `output_path`
+"""
+import csv
+import json
+import sys
+
+
+class NullSink:
+    name = 'none'
+    # whether the sink wants the rows at all
+    wants_rows = False
+
+    def write_row(self, section, address, points, bonus=None):
+        pass
+
+    def write_summary(self, summary):
+        pass
+
+    def close(self):
+        pass
+
+
+class SummarySink(NullSink):
+    name = 'summary'
+
+    def write_summary(self, summary):
+        print(f"Total addresses: {summary['addresses']}, bonus addresses: {summary['bonus_addresses']}, "
+              f"ratio: {summary['bonus_ratio']}")
+        print(f"Total rewards: {summary['total_rewards']}")
+        print(f"Total pending: {summary['total_pending']}")
+
+
+class StreamSink(SummarySink):
+    name = 'stream'
+    wants_rows = True
+
+    def __init__(self, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+
+    def write_row(self, section, address, points, bonus=None):
+        self.stream.write(f"{section}\t{address}\t{points}\t{'' if bonus is None else int(bonus)}\n")
+
+
+class CSVSink(SummarySink):
+    name = 'csv'
+    wants_rows = True
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['section', 'address', 'points', 'bonus'])
+
+    def write_row(self, section, address, points, bonus=None):
+        self.writer.writerow([section, address, points, '' if bonus is None else int(bonus)])
+
+    def close(self):
+        self.file.close()
+
+
+class JSONLSink(SummarySink):
+    name = 'jsonl'
+    wants_rows = True
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write_row(self, section, address, points, bonus=None):
+        row = {'section': section, 'address': address, 'points': points}
+        if bonus is not None:
+            row['bonus'] = bonus
+        self.file.write(json.dumps(row) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+SINKS = {sink.name: sink for sink in [NullSink, SummarySink, StreamSink, CSVSink, JSONLSink]}
+
+
+def get_output_sink(settings):
+    name = settings['output_sink']
+    if name not in SINKS:
+        raise ValueError(f"Unknown output sink {name}, use one of {', '.join(SINKS)}")
+    if name in ('csv', 'jsonl'):
+        if not settings['output_path']:
+            raise ValueError(f"The {name} output sink requires an output path")
+        return SINKS[name](settings['output_path'])
+    return SINKS[name]()
+
+
+def write_points(sink, totals, pending_totals, bonus_addresses):
+    """ Write the totals (with their bonus flag) and pending points, then the summary """
+    bonus_count = 0
+    for address, value in totals.items():
+        bonus = address in bonus_addresses
+        bonus_count += bonus
+        if sink.wants_rows:
+            sink.write_row('totals', address, value, bonus)
+    if sink.wants_rows:
+        for address, value in pending_totals.items():
+            sink.write_row('pending', address, value)
+
+    sink.write_summary({
+        'addresses': len(totals),
+        'bonus_addresses': bonus_count,
+        'bonus_ratio': bonus_count / len(totals) if totals else 0,
+        'total_rewards': sum(totals.values()),
+        'total_pending': sum(pending_totals.values()),
+    })
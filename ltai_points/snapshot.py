@@ -0,0 +1,96 @@
+""" Prepared corechannel snapshots.
+
+Everything a daily round derives from the status alone (active nodes, resource
+node index, staked amounts, resolved and checksummed reward addresses) is
+computed once in a PreparedSnapshot. The same status is evaluated several
+times in a run (the last distribution day, today's pending points, the
+estimates), always as the same status object, so a run keeps its latest
+prepared snapshots by the identity of their status. Hashing the content to
+also match equal copies would cost more than preparing the snapshot again.
+"""
+from collections import OrderedDict
+
+from .addresses import to_checksum_address
+
+SNAPSHOT_CACHE_SIZE = 8
+
+
+def compute_staked_amounts(status):
+    """ Staked amounts by address, each node counting 200000 for its reward address """
+    message_totals = {}
+
+    for node in status['nodes']:
+        reward_address = node.get('reward', None)
+        if reward_address is None or not reward_address:
+            reward_address = node['owner']
+        message_totals[reward_address] = message_totals.get(reward_address, 0) + 200000
+        for address, amount in node['stakers'].items():
+            message_totals[address] = message_totals.get(address, 0) + amount
+
+    return message_totals
+
+
+def resolve_reward_address(entry):
+    """ Checksummed reward address of a node, defaulting to its owner """
+    try:
+        return to_checksum_address(entry.get("reward", None))
+    except Exception:
+        print("Bad reward address, defaulting to owner")
+        return entry["owner"]
+
+
+class PreparedSnapshot:
+    def __init__(self, status):
+        self.active_nodes = [node for node in status['nodes'] if node["status"] == "active"]
+        self.resource_nodes = {rnode['hash']: rnode for rnode in status['resource_nodes']}
+
+        self.staked_amounts = compute_staked_amounts(status)
+        self.total_staked = sum(self.staked_amounts.values())
+        # (checksummed address, amount), in the order of the staked amounts
+        self.staked_rewards = [(to_checksum_address(address), value)
+                               for address, value in self.staked_amounts.items() if address]
+
+        # reward address of each active node (as linked) and the checksummed one (as rewarded)
+        self.node_rewards = []
+        self.node_stakers = []
+        for node in self.active_nodes:
+            reward_address = resolve_reward_address(node)
+            self.node_rewards.append((reward_address, to_checksum_address(reward_address)))
+            self.node_stakers.append([(to_checksum_address(address), value)
+                                      for address, value in node["stakers"].items()])
+        self._rnode_rewards = {}
+
+    def get_rnode_reward(self, rnode):
+        """ Reward address of a resource node, as linked and checksummed """
+        if rnode['hash'] not in self._rnode_rewards:
+            reward_address = resolve_reward_address(rnode)
+            self._rnode_rewards[rnode['hash']] = (reward_address, to_checksum_address(reward_address))
+        return self._rnode_rewards[rnode['hash']]
+
+
+class SnapshotCache:
+    """ Latest prepared snapshots of a run """
+
+    def __init__(self, size=SNAPSHOT_CACHE_SIZE):
+        self.size = size
+        # id of the status -> (status, snapshot), the status is kept so its id can't be reused
+        self.by_id = OrderedDict()
+
+    def get(self, status):
+        entry = self.by_id.get(id(status), None)
+        if entry is not None and entry[0] is status:
+            self.by_id.move_to_end(id(status))
+            return entry[1]
+
+        snapshot = PreparedSnapshot(status)
+        self.by_id[id(status)] = (status, snapshot)
+        while len(self.by_id) > self.size:
+            self.by_id.popitem(last=False)
+        return snapshot
+
+
+def get_prepared_snapshot(status, context=None):
+    """ Prepared snapshot of a status, from the run cache when there is a context """
+    if context is None:
+        return PreparedSnapshot(status)
+    return context.snapshots.get(status)
@@ -2,14 +2,84 @@ import plyvel
 import time
 import json
 import os
+from functools import partial
 from pathlib import Path
+from .delta import apply_dict_diff, make_snapshot_diff
 from .settings import get_settings
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# key marking a stored diff in a DeltaStorage
+DELTA_MARKER = '_delta'
+
+# version bytes of the binary encodings, entries without one are legacy JSON
+MSGPACK_VERSION = b'\x01'
+MSGPACK_ZSTD_VERSION = b'\x02'
+
+
+class JSONCodec:
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data).encode()
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack codec requires the msgpack package")
+
+    def encode(self, data):
+        return MSGPACK_VERSION + msgpack.packb(data, use_bin_type=True)
+
+
+class MsgpackZstdCodec:
+    name = 'msgpack+zstd'
+
+    def __init__(self, level=3):
+        if msgpack is None or zstandard is None:
+            raise ImportError("The msgpack+zstd codec requires the msgpack and zstandard packages")
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def encode(self, data):
+        return MSGPACK_ZSTD_VERSION + self.compressor.compress(msgpack.packb(data, use_bin_type=True))
+
+
+CODECS = {codec.name: codec for codec in [JSONCodec, MsgpackCodec, MsgpackZstdCodec]}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Unknown storage codec {name}, use one of {', '.join(CODECS)}")
+    return CODECS[name]()
+
+
+def decode_entry(value):
+    """ Decode a stored value whatever the codec it was written with """
+    version = value[:1]
+    if version == MSGPACK_VERSION:
+        return msgpack.unpackb(value[1:], raw=False)
+    elif version == MSGPACK_ZSTD_VERSION:
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(value[1:]), raw=False)
+    return json.loads(value.decode())
+
+
 class Storage:
-    def __init__(self, db_path, db_name):
+    def __init__(self, db_path, db_name, codec='json'):
         self.db_path = os.path.join(db_path, db_name)
         Path(self.db_path).mkdir(parents=True, exist_ok=True)
         self.db = plyvel.DB(self.db_path, create_if_missing=True)
+        self.codec = get_codec(codec)
 
     # async def __aenter__(self):
     #     return self
@@ -20,39 +90,164 @@ class Storage:
     def close(self):    
         self.db.close()
 
+    def namespace(self, name):
+        """ Return a view of this storage with all keys scoped under `name`.
+        The view shares the underlying database, only close the parent. """
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view.db = self.db.prefixed_db(f'{name}/'.encode())
+        return view
+
     async def store_entry(self, key, data):
         key = f'item:{key}'
         existing_entry = self.db.get(key.encode())
         if existing_entry is None:
-            json_data = json.dumps(data)
-            self.db.put(key.encode(), json_data.encode())
+            self.db.put(key.encode(), self.codec.encode(data))
+
+    async def get_entry(self, key):
+        value = self.db.get(f'item:{key}'.encode())
+        if value is None:
+            return None
+        return decode_entry(value)
+
+    async def delete_entry(self, key):
+        self.db.delete(f'item:{key}'.encode())
+
+    def _iterator(self, start_key=None, end_key=None, **kwargs):
+        """ Iterate over the items between start_key and end_key (both included) """
+        start = b'item:' if start_key is None else f'item:{start_key}'.encode()
+        if end_key is None:
+            return self.db.iterator(start=start, stop=b'item;', **kwargs)
+        return self.db.iterator(start=start, stop=f'item:{end_key}'.encode(), include_stop=True, **kwargs)
 
     async def retrieve_entries(self, start_key=None, end_key=None):
-        for key, value in self.db.iterator(prefix=b'item:'):
+        for key, value in self._iterator(start_key, end_key):
             key = key.decode().split(':')[1]
-            if start_key is not None and key < start_key:
-                continue
-            if end_key is not None and key > end_key:
-                continue
+            yield (key, decode_entry(value))
+
+    async def retrieve_keys(self, start_key=None, end_key=None):
+        for key in self._iterator(start_key, end_key, include_value=False):
+            yield key.decode().split(':')[1]
 
-            json_data = value.decode()
-            data = json.loads(json_data)
-            yield (key, data)
+    async def count_entries(self, start_key=None, end_key=None):
+        return sum(1 for _ in self._iterator(start_key, end_key, include_value=False))
 
     async def get_last_available_key(self):
-        last_key = None
-        for key, _ in self.db.iterator(prefix=b'item:', reverse=True):
-            val = key.decode().split(',')[0].split(':')[1]
-            if last_key is None or val > last_key:
-                last_key = val
-        return last_key
+        for key in self._iterator(reverse=True, include_value=False):
+            return key.decode().split(',')[0].split(':')[1]
+        return None
+
+    async def migrate(self):
+        """ Rewrite every entry (of every namespace) with the current codec """
+        count = 0
+        with self.db.write_batch() as batch:
+            for key, value in self.db.iterator():
+                batch.put(key, self.codec.encode(decode_entry(value)))
+                count += 1
+        return count
+
+class DeltaStorage(Storage):
+    """ Storage for a history of similar snapshots. We keep a full keyframe
+    every `keyframe_interval` entries, and only the diff to the previous entry
+    (see delta.py) in between. Entries are rebuilt on retrieval. """
+
+    def __init__(self, db_path, db_name, codec='json', keyframe_interval=30):
+        super().__init__(db_path, db_name, codec=codec)
+        self.keyframe_interval = keyframe_interval
+        self._last_stored = None
+
+    def _get_frame(self, key):
+        value = self.db.get(f'item:{key}'.encode())
+        if value is None:
+            return None
+        return decode_entry(value)
+
+    def _load(self, key, frame=None):
+        """ Rebuild the entry at `key`, returns (entry, depth from its keyframe) """
+        if frame is None:
+            frame = self._get_frame(key)
+        if DELTA_MARKER not in frame:
+            return frame, 0
+        delta = frame[DELTA_MARKER]
+        base, _ = self._load(delta['base'])
+        return apply_dict_diff(base, delta['diff']), delta['depth']
+
+    def _encode_frame(self, key, data, previous):
+        """ Frame to store for `data`, given the (key, entry, depth) before it """
+        if previous is not None:
+            previous_key, previous_entry, previous_depth = previous
+            if previous_depth + 1 < self.keyframe_interval:
+                diff = make_snapshot_diff(previous_entry, data)
+                if diff is not None:
+                    return {DELTA_MARKER: {'base': previous_key,
+                                           'depth': previous_depth + 1,
+                                           'diff': diff}}, previous_depth + 1
+        return data, 0
+
+    async def get_entry(self, key):
+        frame = self._get_frame(key)
+        if frame is None:
+            return None
+        return self._load(key, frame)[0]
+
+    async def store_entry(self, key, data):
+        if self._get_frame(key) is not None:
+            return
+
+        previous = self._last_stored
+        if previous is None or previous[0] >= key:
+            previous = None
+            for previous_key, value in self.db.iterator(start=b'item:', stop=f'item:{key}'.encode(),
+                                                        reverse=True):
+                previous_key = previous_key.decode().split(':')[1]
+                previous = (previous_key, *self._load(previous_key, decode_entry(value)))
+                break
+
+        frame, depth = self._encode_frame(key, data, previous)
+        self.db.put(f'item:{key}'.encode(), self.codec.encode(frame))
+        self._last_stored = (key, data, depth)
+
+    async def retrieve_entries(self, start_key=None, end_key=None):
+        previous_key = previous_entry = None
+        async for key, frame in super().retrieve_entries(start_key=start_key, end_key=end_key):
+            if DELTA_MARKER in frame and frame[DELTA_MARKER]['base'] == previous_key:
+                entry = apply_dict_diff(previous_entry, frame[DELTA_MARKER]['diff'])
+            else:
+                entry, _ = self._load(key, frame)
+            yield key, entry
+            previous_key, previous_entry = key, entry
+
+    async def migrate(self):
+        """ Rewrite every entry with the current codec, as keyframes and diffs """
+        count = 0
+        previous = None
+        with self.db.write_batch() as batch:
+            async for key, entry in self.retrieve_entries():
+                frame, depth = self._encode_frame(key, entry, previous)
+                batch.put(f'item:{key}'.encode(), self.codec.encode(frame))
+                previous = (key, entry, depth)
+                count += 1
+        self._last_stored = None
+        return count
 
 def get_dbs(settings):
+    codec = settings['storage_codec']
+    corechannel_storage = Storage
+    if settings['corechannel_storage'] == 'delta':
+        corechannel_storage = partial(DeltaStorage, keyframe_interval=settings['keyframe_interval'])
     return {
-        'staked_amounts': Storage(settings['db_path'], 'staked_amounts'),
-        'corechannel_status': Storage(settings['db_path'], 'corechannel_status'),
+        'staked_amounts': Storage(settings['db_path'], 'staked_amounts', codec=codec),
+        'corechannel_status': corechannel_storage(settings['db_path'], 'corechannel_status', codec=codec),
+        'points_ledger': Storage(settings['db_path'], 'points_ledger', codec=codec),
+        'token_state': Storage(settings['db_path'], 'token_state', codec=codec),
+        'block_timestamps': Storage(settings['db_path'], 'block_timestamps', codec=codec),
     }
 
+async def migrate_dbs(dbs):
+    for name, db in dbs.items():
+        count = await db.migrate()
+        print(f"Rewrote {count} entries of {name} with the {db.codec.name} codec")
+
 def close_dbs(dbs):
     for db in dbs.values():
         db.close()
@@ -20,6 +20,12 @@ requirements = [
     'pyyaml'
 ]
 
+extras_requirements = {
+    'storage': ['msgpack', 'zstandard'],
+    'simulation': ['eth-tester[py-evm]', 'py-solc-x'],
+    'profiling': ['pyinstrument'],
+}
+
 test_requirements = [ ]
 
 setup(
@@ -43,6 +49,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
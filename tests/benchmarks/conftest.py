@@ -0,0 +1,17 @@
+"""The benchmarks only run on demand, with --benchmark-only."""
+
+import pathlib
+
+import pytest
+
+BENCHMARKS_DIR = pathlib.Path(__file__).parent
+
+
+def pytest_collection_modifyitems(config, items):
+    # the option is only there with pytest-benchmark installed
+    if config.getoption('benchmark_only', default=False):
+        return
+    skip = pytest.mark.skip(reason='run the benchmarks with --benchmark-only')
+    for item in items:
+        if BENCHMARKS_DIR in item.path.parents:
+            item.add_marker(skip)
@@ -0,0 +1,131 @@
+"""Deterministic synthetic inputs for the benchmarks."""
+
+from datetime import datetime, timedelta, timezone
+import random
+from types import SimpleNamespace
+
+from web3._utils.method_formatters import log_entry_formatter
+
+# (nodes, resource nodes, stakers)
+SCALES = {
+    'small': (30, 80, 300),
+    'current': (150, 500, 3000),
+    'doubled': (300, 1000, 6000),
+}
+
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+ZERO_ADDRESS = '0x' + '0' * 40
+TOKEN_CONTRACT = '0x' + 'a' * 40
+
+
+def make_address(i):
+    return '0x' + f'{i:040x}'
+
+
+def make_status(seed, node_count, crn_count, staker_count, edge_cases=False):
+    """ Corechannel status with `node_count` nodes, `crn_count` resource nodes
+    linked to them and `staker_count` stakers spread over 1 to 3 nodes each.
+    With `edge_cases`, some reward addresses are missing or invalid and some
+    nodes list resource nodes that don't exist """
+    rnd = random.Random(seed)
+    nodes = [{
+        'hash': f'node{i}',
+        'owner': make_address(1 + i),
+        'reward': rnd.choice([make_address(1 + i), make_address(100000 + i)] + (['', None] if edge_cases else [])),
+        'status': 'active' if rnd.random() < 0.9 else 'waiting',
+        'score': rnd.uniform(0.5, 1),
+        'resource_nodes': [],
+        'stakers': {},
+    } for i in range(node_count)]
+    resource_nodes = []
+    for i in range(crn_count):
+        node = rnd.choice(nodes)
+        resource_nodes.append({
+            'hash': f'crn{i}',
+            'owner': make_address(200000 + i),
+            # operators running many resource nodes send their rewards to one address
+            'reward': make_address(300000 + i % max(1, crn_count // 4)),
+            'status': 'linked' if rnd.random() < 0.95 else 'waiting',
+            'score': rnd.uniform(0.1, 1),
+            'decentralization': rnd.random(),
+        })
+        node['resource_nodes'].append(f'crn{i}')
+    for i in range(staker_count):
+        for node in rnd.sample(nodes, rnd.randint(1, min(3, node_count))):
+            node['stakers'][make_address(400000 + i)] = rnd.uniform(10000, 500000)
+    if edge_cases:
+        for resource_node in resource_nodes:
+            if rnd.random() < 0.2:
+                resource_node['reward'] = rnd.choice([None, 'bad'])
+        for i, node in enumerate(nodes):
+            if rnd.random() < 0.1:
+                node['resource_nodes'].append(f'crn{crn_count + i}')
+    return {'nodes': nodes, 'resource_nodes': resource_nodes}
+
+
+def make_status_history(start_date, days, node_count, crn_count, staker_count, seed=0):
+    """ One status per day as (date, status), with a few nodes changing every day """
+    status = make_status(seed, node_count, crn_count, staker_count)
+    rnd = random.Random(seed)
+    history = []
+    for i in range(days):
+        status = dict(status, nodes=list(status['nodes']))
+        for _ in range(max(1, node_count // 50)):
+            position = rnd.randrange(node_count)
+            status['nodes'][position] = dict(status['nodes'][position], score=rnd.uniform(0.5, 1))
+        history.append(((start_date + timedelta(days=i)).isoformat(), status))
+    return history
+
+
+def make_registration_messages(count, start_ts, seed=0):
+    """ LIBERTAI aggregate messages as returned by the aleph client, some
+    addresses registering several times """
+    rnd = random.Random(seed)
+    return [SimpleNamespace(
+        sender=make_address(400000 + rnd.randrange(count)),
+        time=datetime.fromtimestamp(start_ts + rnd.randrange(86400 * 60), timezone.utc),
+        content=SimpleNamespace(key='libertai', content={'registered': True}),
+    ) for _ in range(count)]
+
+
+def make_transfer_logs(count, address_count=1000, mint_ratio=0.7, start_block=1000000, seed=0):
+    """ Synthetic Transfer logs as returned by eth_getLogs and formatted by web3, mostly
+    mints, one transaction per log """
+    rnd = random.Random(seed)
+    logs = []
+    block_number = start_block
+    position = 0
+    for i in range(count):
+        if rnd.random() < 0.2:
+            block_number += rnd.randint(1, 50)
+            position = 0
+        sender = ZERO_ADDRESS if rnd.random() < mint_ratio else make_address(400000 + rnd.randrange(address_count))
+        recipient = make_address(400000 + rnd.randrange(address_count))
+        logs.append(log_entry_formatter({
+            'address': TOKEN_CONTRACT,
+            'topics': [TRANSFER_TOPIC,
+                       '0x' + sender[2:].rjust(64, '0'),
+                       '0x' + recipient[2:].rjust(64, '0')],
+            'data': '0x' + f'{rnd.randrange(10**24):064x}',
+            'blockNumber': hex(block_number),
+            'transactionHash': '0x' + f'{i:064x}',
+            'transactionIndex': hex(position),
+            'blockHash': '0x' + f'{block_number:064x}',
+            'logIndex': hex(position),
+            'removed': False,
+        }))
+        position += 1
+    return logs
+
+
+def make_linear_allocations(count, seed=0):
+    rnd = random.Random(seed)
+    return [{
+        'type': 'linear',
+        'address': make_address(500000 + i),
+        'amount': rnd.uniform(1000, 1000000),
+        'duration': rnd.choice([365, 730, 1095]),
+        'cliff': rnd.choice([0, 90, 180]),
+        'pool': 'team',
+        'distributed': 0,
+    } for i in range(count)]
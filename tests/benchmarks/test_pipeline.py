@@ -0,0 +1,121 @@
+"""Benchmarks of compute_points (with the aleph fetchers stubbed) and of the token state sync."""
+
+import asyncio
+import contextlib
+from datetime import datetime, timedelta, timezone
+import os
+import shutil
+import tempfile
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+from ltai_points import ethereum, fetcher
+from ltai_points import ltai_points
+from ltai_points.settings import get_settings
+from ltai_points.storage import close_dbs, get_dbs
+from ltai_points.supply import get_supply_info
+from tests.benchmarks.generators import (SCALES, TOKEN_CONTRACT, make_address, make_registration_messages,
+                                         make_status_history, make_transfer_logs)
+
+SUPPLY_FILENAME = os.path.join(os.path.dirname(__file__), '..', '..', 'sample_supply.yaml')
+HISTORY_DAYS = 30
+
+
+@pytest.fixture(scope='module')
+def settings():
+    return dict(get_settings(), bonus_addresses=[make_address(400001)], supply_filename=SUPPLY_FILENAME,
+                ethereum_token_contract=TOKEN_CONTRACT)
+
+
+def stub_fetchers(monkeypatch, settings, scale):
+    today = datetime.now(timezone.utc).date()
+    history = make_status_history(today - timedelta(days=HISTORY_DAYS - 1), HISTORY_DAYS, *SCALES[scale])
+    messages = make_registration_messages(SCALES[scale][2] // 10, settings['reward_start_ts'])
+
+    async def get_corechanel_statuses(settings, dbs, start_key=None):
+        for ddate, status in history:
+            if start_key is None or ddate >= start_key:
+                yield ddate, status
+
+    async def fetch_messages(client, filter, **kwargs):
+        for message in messages:
+            yield message
+
+    monkeypatch.setattr(ltai_points, 'get_corechanel_statuses', get_corechanel_statuses)
+    monkeypatch.setattr(fetcher, 'fetch_messages', fetch_messages)
+    monkeypatch.setattr(fetcher, 'AlephHttpClient', lambda **kwargs: contextlib.nullcontext())
+
+
+def run_compute_points(settings, dbs):
+    pools, max_supply, allocations = get_supply_info(settings)
+    balances = {make_address(400000 + i): 100 for i in range(100)}
+    last_distribution = datetime.now(timezone.utc) - timedelta(days=3)
+    return asyncio.run(ltai_points.compute_points(settings, dbs, dict(balances), balances, pools, allocations,
+                                                  last_distribution.timestamp(), {}))
+
+
+@pytest.mark.parametrize('scale', list(SCALES))
+def test_compute_points_cold(benchmark, monkeypatch, settings, scale):
+    """ Every day is computed and stored in a fresh points ledger """
+    stub_fetchers(monkeypatch, settings, scale)
+    db_paths, dbs_list = [], []
+
+    def setup():
+        db_paths.append(tempfile.mkdtemp())
+        dbs_list.append(get_dbs(dict(settings, db_path=db_paths[-1])))
+        return (settings, dbs_list[-1]), {}
+
+    try:
+        benchmark.pedantic(run_compute_points, setup=setup, rounds=3)
+    finally:
+        for dbs in dbs_list:
+            close_dbs(dbs)
+        for db_path in db_paths:
+            shutil.rmtree(db_path)
+
+
+@pytest.mark.parametrize('scale', list(SCALES))
+def test_compute_points_ledger(benchmark, monkeypatch, tmp_path, settings, scale):
+    """ Completed days are replayed from the points ledger """
+    stub_fetchers(monkeypatch, settings, scale)
+    dbs = get_dbs(dict(settings, db_path=str(tmp_path)))
+    try:
+        run_compute_points(settings, dbs)
+        benchmark.pedantic(run_compute_points, args=(settings, dbs), rounds=3)
+    finally:
+        close_dbs(dbs)
+
+
+class StaticProvider(BaseProvider):
+    """ Only answers the block number, the logs and timestamps are stubbed """
+
+    def __init__(self, block_number):
+        super().__init__()
+        self.block_number = block_number
+
+    def make_request(self, method, params):
+        assert method == 'eth_blockNumber', method
+        return {'jsonrpc': '2.0', 'id': 0, 'result': hex(self.block_number)}
+
+
+@pytest.mark.parametrize('count', [1000, 10000, 50000])
+def test_token_state(benchmark, monkeypatch, settings, count):
+    logs = make_transfer_logs(count)
+
+    async def get_logs(web3, contract, start_height, **kwargs):
+        for log in logs:
+            yield log
+
+    async def lookup_timestamps(web3, block_numbers, block_timestamps, cache_db=None):
+        return {block_number: block_number * 2 for block_number in block_numbers}
+
+    monkeypatch.setattr(ethereum, 'get_logs', get_logs)
+    monkeypatch.setattr(ethereum, 'lookup_timestamps', lookup_timestamps)
+    web3 = Web3(StaticProvider(logs[-1]['blockNumber'] + 1000))
+
+    benchmark(lambda: asyncio.run(ethereum.get_token_state(settings, web3)))
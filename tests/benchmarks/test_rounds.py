@@ -0,0 +1,62 @@
+"""Benchmarks of a daily round, of the address clustering and of the linear allocations."""
+
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from ltai_points.context import RunContext
+from ltai_points.ltai_points import get_cluster_reward_multipliers, process_virtual_daily_round
+from ltai_points.settings import get_settings
+from ltai_points.supply import get_linear_allocs
+from tests.benchmarks.generators import (SCALES, make_address, make_linear_allocations, make_status,
+                                         make_status_history)
+
+
+@pytest.fixture(scope='module')
+def settings():
+    return dict(get_settings(), bonus_addresses=[make_address(400001)])
+
+
+@pytest.mark.parametrize('scale', list(SCALES))
+def test_daily_round(benchmark, settings, scale):
+    status = make_status(0, *SCALES[scale])
+    registrations = {make_address(400000 + i): settings['bonus_limit_ts'] - 86400 * i for i in range(100)}
+
+    def run():
+        asyncio.run(process_virtual_daily_round('2024-02-01', status, {}, registrations, settings,
+                                                context=RunContext(settings)))
+
+    benchmark(run)
+
+
+@pytest.mark.parametrize('scale', list(SCALES))
+def test_address_clustering(benchmark, settings, scale):
+    """ Linking a month of rounds (what the old process_address_links closed over) and
+    computing the multipliers of the clusters """
+    links = []
+    for _, status in make_status_history(datetime(2024, 1, 1), 30, *SCALES[scale]):
+        for node in status['nodes']:
+            links.append((node['hash'], node['owner'], node['reward']))
+        for rnode in status['resource_nodes']:
+            links.append((rnode['hash'], rnode['owner'], rnode['reward']))
+    addresses = sorted(set(address for link in links for address in link[1:]))
+    balances = {address: 1000 + i for i, address in enumerate(addresses)}
+    previous_mints = {address: 2000 for address in addresses}
+
+    def run():
+        context = RunContext(settings)
+        for link in links:
+            context.link_addresses(*link)
+        return get_cluster_reward_multipliers(context.clusters, previous_mints, balances)
+
+    benchmark(run)
+
+
+@pytest.mark.parametrize('count', [10, 1000, 10000])
+def test_linear_allocs(benchmark, settings, count):
+    allocations = make_linear_allocations(count)
+    check_time = datetime(2025, 6, 1, tzinfo=timezone.utc)
+    benchmark(get_linear_allocs, settings, allocations, check_time)
@@ -0,0 +1,26 @@
+"""Benchmark of the fast Transfer decoder against web3's generic one."""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import web3
+
+from ltai_points.ethereum import decode_transfer_log, get_event_data
+from tests.benchmarks.generators import make_transfer_logs
+from tests.test_ethereum import get_transfer_abi
+
+
+@pytest.fixture(scope='module')
+def transfer_logs():
+    return make_transfer_logs(1000)
+
+
+def test_generic_transfer_decoding(benchmark, transfer_logs):
+    codec = web3.Web3().codec
+    abi = get_transfer_abi()
+    benchmark(lambda: [get_event_data(codec, abi, log) for log in transfer_logs])
+
+
+def test_fast_transfer_decoding(benchmark, transfer_logs):
+    benchmark(lambda: [decode_transfer_log(log) for log in transfer_logs])
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+"""Tests for the `ltai_points.ethereum` module."""
+
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import web3
+from web3.providers.base import BaseProvider, JSONBaseProvider
+
+from ltai_points import ethereum
+from ltai_points.ethereum import (decode_transfer_log, get_event_data, get_token_contract_abi,
+                                  get_transfer_decoder, is_erc20_transfer_abi)
+from ltai_points import simulation
+from ltai_points.settings import get_settings
+from ltai_points.storage import close_dbs, get_dbs
+from tests.benchmarks.generators import make_transfer_logs
+
+
+def get_transfer_abi():
+    return [item for item in get_token_contract_abi() if item.get('name') == 'Transfer'][0]
+
+
+class FailingLogsProvider(BaseProvider):
+    """ Answers the block number, and fails every log query with `error` """
+
+    def __init__(self, block_number, error):
+        super().__init__()
+        self.block_number = block_number
+        self.error = error
+
+    def make_request(self, method, params):
+        if method == 'eth_blockNumber':
+            return {'jsonrpc': '2.0', 'id': 0, 'result': hex(self.block_number)}
+        assert method == 'eth_getLogs', method
+        return {'jsonrpc': '2.0', 'id': 0, 'error': self.error}
+
+
+def get_block(params):
+    block_number = int(params[0], 16)
+    return {'number': hex(block_number), 'timestamp': hex(1700000000 + 12 * block_number)}
+
+
+class BlocksProvider(BaseProvider):
+    """ Answers block requests one at a time """
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def make_request(self, method, params):
+        assert method == 'eth_getBlockByNumber', method
+        self.requests.append(1)
+        return {'jsonrpc': '2.0', 'id': 0, 'result': get_block(params)}
+
+
+class BatchBlocksProvider(JSONBaseProvider):
+    """ Answers block requests in JSON-RPC batches """
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def make_request(self, method, params):
+        raise AssertionError("blocks should be requested in batches")
+
+    def make_batch_request(self, requests):
+        self.requests.append(len(requests))
+        return [{'jsonrpc': '2.0', 'id': i, 'result': get_block(params)}
+                for i, (method, params) in enumerate(requests)]
+
+
+class LatestBlockProvider(BaseProvider):
+    """ Answers the latest block, with a gas limit """
+
+    def __init__(self, gas_limit):
+        super().__init__()
+        self.gas_limit = gas_limit
+
+    def make_request(self, method, params):
+        assert method == 'eth_getBlockByNumber' and params[0] == 'latest', (method, params)
+        return {'jsonrpc': '2.0', 'id': 0, 'result': {'number': '0x1', 'gasLimit': hex(self.gas_limit)}}
+
+
+class TestTransferDecoding(unittest.TestCase):
+    """Tests for the Transfer log decoders."""
+
+    def setUp(self):
+        self.abi = get_transfer_abi()
+        self.codec = web3.Web3().codec
+
+    def test_transfer_abi_detection(self):
+        self.assertTrue(is_erc20_transfer_abi(self.abi))
+        self.assertIs(get_transfer_decoder(web3.Web3(), self.abi), decode_transfer_log)
+
+        approval_abi = [item for item in get_token_contract_abi() if item.get('name') == 'Approval'][0]
+        self.assertFalse(is_erc20_transfer_abi(approval_abi))
+        self.assertIsNot(get_transfer_decoder(web3.Web3(), approval_abi), decode_transfer_log)
+
+    def test_fast_decoder_matches_generic(self):
+        # synthetic logs, mints and transfers with random amounts
+        for log in make_transfer_logs(60, address_count=20, mint_ratio=0.5):
+            expected = get_event_data(self.codec, self.abi, log)
+            result = decode_transfer_log(log)
+            self.assertEqual(dict(expected['args']), result['args'])
+            for key in ['event', 'logIndex', 'transactionIndex', 'transactionHash',
+                        'address', 'blockHash', 'blockNumber']:
+                self.assertEqual(expected[key], result[key])
+
+
+class TestTokenState(unittest.TestCase):
+    """Tests the token state checkpoints."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings = dict(get_settings(), db_path=self.tmpdir.name, ethereum_log_retries=0)
+        self.dbs = get_dbs(self.settings)
+
+    def tearDown(self):
+        close_dbs(self.dbs)
+        self.tmpdir.cleanup()
+
+    def test_failed_sync_keeps_checkpoint(self):
+        state_db = ethereum.get_token_state_db(self.settings, self.dbs)
+        state = dict(ethereum.get_empty_token_state(self.settings), synced_height=1000)
+        asyncio.run(ethereum.store_token_state(state_db, state))
+
+        provider = FailingLogsProvider(5000, {'code': 429, 'message': 'Too many requests'})
+        with self.assertRaises(ethereum.RPC_ERRORS):
+            asyncio.run(ethereum.get_token_state(self.settings, web3.Web3(provider), dbs=self.dbs))
+
+        stored = asyncio.run(ethereum.load_token_state(self.settings, state_db))
+        self.assertEqual(stored['synced_height'], 1000)
+
+
+class TestBlockTimestamps(unittest.TestCase):
+    """Tests the batched block timestamp lookups."""
+
+    def test_blocks_are_batched(self):
+        for provider, requests in [(BatchBlocksProvider(), [2]), (BlocksProvider(), [1, 1])]:
+            blocks = ethereum.get_blocks(web3.Web3(provider), [5, 7])
+            self.assertEqual([block['timestamp'] for block in blocks], [1700000060, 1700000084])
+            self.assertEqual(provider.requests, requests)
+
+    def test_lookup_timestamps(self):
+        provider = BatchBlocksProvider()
+        w3 = web3.Web3(provider)
+        with tempfile.TemporaryDirectory() as db_path:
+            settings = dict(get_settings(), db_path=db_path)
+            dbs = get_dbs(settings)
+            try:
+                cache_db = ethereum.get_block_timestamps_db(settings, dbs)
+                block_numbers = [30, 10, 20, 10, 250]
+                expected = {block_number: 1700000000 + 12 * block_number for block_number in block_numbers}
+
+                timestamps = asyncio.run(ethereum.lookup_timestamps(w3, block_numbers, {10: expected[10]},
+                                                                    cache_db=cache_db, batch_size=2))
+                self.assertEqual(timestamps, expected)
+                # each distinct block missing from the dict is fetched once, in batches of at most 2
+                self.assertEqual(provider.requests, [2, 1])
+
+                # then they come from the persistent cache
+                timestamps = asyncio.run(ethereum.lookup_timestamps(w3, block_numbers + [40], {},
+                                                                    cache_db=cache_db))
+                self.assertEqual(timestamps, {**expected, 40: 1700000480})
+                self.assertEqual(provider.requests, [2, 1, 2])
+            finally:
+                close_dbs(dbs)
+
+
+class TestMintGas(unittest.TestCase):
+    """Tests the mint batch sizing."""
+
+    def test_mint_batch_size(self):
+        settings = dict(get_settings(), ethereum_block_gas_fraction=0.25, ethereum_gas_margin=1.25)
+        w3 = web3.Web3(LatestBlockProvider(30000000))
+        # 30M * 0.25 / 1.25 = 6M gas per batch
+        self.assertEqual(ethereum.get_mint_batch_size(settings, w3, 50000, 25000, 1000), 238)
+        # capped to the max size
+        self.assertEqual(ethereum.get_mint_batch_size(settings, w3, 50000, 25000, 100), 100)
+        # at least one recipient, even when one doesn't fit
+        self.assertEqual(ethereum.get_mint_batch_size(settings, w3, 50000, 10000000, 100), 1)
+        # without a per recipient cost, the block isn't even queried
+        self.assertEqual(ethereum.get_mint_batch_size(settings, None, 50000, 0, 100), 100)
+
+
+class TestLogWindows(unittest.TestCase):
+    """Tests the concurrent log windows."""
+
+    def get_window_logs(self, start_height, last_block, **kwargs):
+        async def collect():
+            return [log['blockNumber'] async for log in ethereum.get_logs_windows(
+                None, None, start_height, last_block, None, backoff=0, **kwargs)]
+        return asyncio.run(collect())
+
+    def test_range_errors(self):
+        self.assertTrue(ethereum.is_range_error(
+            ValueError({'code': -32005, 'message': 'query returned more than 10000 results'})))
+        self.assertTrue(ethereum.is_range_error(
+            ValueError({'code': -32602, 'message': 'Log response size exceeded.'})))
+        self.assertFalse(ethereum.is_range_error(
+            ValueError({'code': -32005, 'message': 'daily request count exceeded, request rate limited'})))
+        self.assertFalse(ethereum.is_range_error(ValueError({'code': -32603, 'message': 'internal error'})))
+        self.assertFalse(ethereum.is_range_error(ValueError('no code')))
+
+    def test_windows_are_split_and_retried(self):
+        failed = set()
+
+        def query_logs(web3, contract, start_height, end_height, topics, **kwargs):
+            if end_height - start_height >= 100:
+                raise ValueError({'code': -32005, 'message': 'query returned more than 10000 results'})
+            if start_height not in failed:
+                failed.add(start_height)
+                raise ValueError({'code': -32603, 'message': 'internal error'})
+            return [{'blockNumber': block} for block in range(start_height, end_height + 1)]
+
+        with mock.patch.object(ethereum, 'query_logs', query_logs):
+            self.assertEqual(self.get_window_logs(1, 1000, window=400),
+                             list(range(1, 1001)))
+
+    def test_retries_are_bounded(self):
+        def query_logs(web3, contract, start_height, end_height, topics, **kwargs):
+            raise ValueError({'code': 429, 'message': 'Too many requests'})
+
+        with mock.patch.object(ethereum, 'query_logs', query_logs):
+            with self.assertRaises(ValueError):
+                self.get_window_logs(1, 1000, retries=2)
+
+    def test_stalled_window_bounds_the_buffer(self):
+        released = threading.Event()
+        queried = []
+
+        def query_logs(web3, contract, start_height, end_height, topics, **kwargs):
+            queried.append(start_height)
+            if start_height == 1:
+                released.wait(5)
+            return [{'blockNumber': start_height}]
+
+        def release():
+            # the windows queried while the first one is stalled
+            self.queried_while_stalled = len(queried)
+            released.set()
+
+        timer = threading.Timer(0.5, release)
+        timer.start()
+        with mock.patch.object(ethereum, 'query_logs', query_logs):
+            logs = self.get_window_logs(1, 1000, window=10, concurrency=2, max_buffered=3,
+                                        target_logs=1)
+        timer.join()
+        self.assertEqual(logs, list(range(1, 1001, 10)))
+        self.assertLessEqual(self.queried_while_stalled, 5)
+
+
+@unittest.skipIf(simulation.EthereumTester is None or simulation.solcx is None,
+                 "eth-tester or py-solc-x is not installed")
+class TestMintSimulation(unittest.TestCase):
+    """Tests the mint batching against the in-process chain."""
+
+    def test_standin_token_is_the_compiled_contract(self):
+        web3, settings = simulation.get_simulation(get_settings())
+        compiled = simulation.compile_standin_token()
+        self.assertEqual(bytes(web3.eth.get_code(settings['ethereum_token_contract'])),
+                         bytes.fromhex(compiled['bin-runtime']))
+        # the mint entry points of the contract are those of the token
+        token_abi = {item['name']: item for item in get_token_contract_abi() if item['type'] == 'function'}
+        for item in compiled['abi']:
+            if item.get('name') in ('bulkMint', 'ownerBulkMint'):
+                self.assertEqual([arg['type'] for arg in item['inputs']],
+                                 [arg['type'] for arg in token_abi[item['name']]['inputs']])
+
+    def test_distribution_is_synced_back(self):
+        settings = dict(get_settings(), ethereum_batch_size=20)
+        report = asyncio.run(simulation.simulate_distribution(settings, 45))
+        self.assertEqual(report['transactions'], 3)
+        self.assertEqual(report['batch_size'], 20)
+        self.assertEqual(report['mismatches'], 0)
+
+    def test_standin_token_checks(self):
+        web3, settings = simulation.get_simulation(get_settings())
+        tokens = ethereum.get_token_contract(settings, web3)
+        recipients = list(simulation.get_simulation_targets(3))
+        owner, other = web3.eth.accounts[:2]
+
+        for call in [tokens.functions.ownerBulkMint(recipients, [1, 2, 3]),
+                     tokens.functions.bulkMint(recipients, [1, 2, 3])]:
+            with self.assertRaises(Exception):
+                call.estimate_gas({'from': other})
+        with self.assertRaises(Exception):
+            tokens.functions.bulkMint(recipients, [1, 2]).estimate_gas({'from': owner})
+        with self.assertRaises(Exception):
+            tokens.functions.bulkMint(recipients[:1], [simulation.STANDIN_CAP + 1]).estimate_gas({'from': owner})
+
+        allowance_slot = web3.solidity_keccak(['uint256', 'uint256'],
+                                              [int(owner, 16), simulation.MINTER_ALLOWANCES_SLOT])
+        tokens.functions.bulkMint(recipients, [1, 2, 3]).transact({'from': owner})
+        self.assertEqual(int.from_bytes(web3.eth.get_storage_at(tokens.address, allowance_slot), 'big'),
+                         simulation.STANDIN_CAP - 6)
+        self.assertEqual(int.from_bytes(web3.eth.get_storage_at(tokens.address, simulation.TOTAL_SUPPLY_SLOT),
+                                        'big'), 6)
+
+    def test_new_recipients_after_existing_holders(self):
+        web3, settings = simulation.get_simulation(get_settings())
+        targets = simulation.get_simulation_targets(210)
+        # the fit is sampled on the first targets, make them existing holders
+        holders = dict(list(targets.items())[:10])
+        asyncio.run(ethereum.distribute_tokens(settings, web3, holders))
+
+        report = asyncio.run(ethereum.distribute_tokens(settings, web3, targets, batch_size=50))
+        self.assertEqual([batch['status'] for batch in report['batches']], ['success'] * 5)
+
+    def distribute_with_send(self, send_raw_transaction):
+        web3, settings = simulation.get_simulation(dict(get_settings(), ethereum_batch_size=10))
+        original_send = web3.eth.send_raw_transaction
+        sent = []
+
+        def send(raw_transaction):
+            sent.append(raw_transaction)
+            return send_raw_transaction(original_send, len(sent) - 1, raw_transaction)
+
+        with mock.patch.object(web3.eth, 'send_raw_transaction', send):
+            report = asyncio.run(ethereum.distribute_tokens(
+                settings, web3, simulation.get_simulation_targets(35), batch_size=10))
+        return [batch['status'] for batch in report['batches']]
+
+    def test_rejected_batch_stops_the_next_ones(self):
+        def send_raw_transaction(send, index, raw_transaction):
+            if index == 1:
+                raise ValueError({'code': -32000, 'message': 'insufficient funds for gas * price + value'})
+            return send(raw_transaction)
+
+        self.assertEqual(self.distribute_with_send(send_raw_transaction),
+                         ['success', 'rejected', 'not_sent', 'not_sent'])
+
+    def test_nonce_too_low_checks_the_receipt(self):
+        def send_raw_transaction(send, index, raw_transaction):
+            if index == 1:
+                # sent by a previous attempt, the node refuses it again
+                send(raw_transaction)
+                raise ValueError({'code': -32000, 'message': 'nonce too low'})
+            return send(raw_transaction)
+
+        self.assertEqual(self.distribute_with_send(send_raw_transaction), ['success'] * 4)
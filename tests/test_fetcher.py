@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""Tests for the `ltai_points.fetcher` module."""
+
+import asyncio
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+import aiohttp
+
+from ltai_points import fetcher
+from ltai_points.settings import get_settings
+from ltai_points.storage import close_dbs, get_dbs
+
+DAY = 86400
+
+
+def get_date(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+
+
+class FakeAlephClient:
+    """ Answers one corechannel message per queried bucket """
+
+    def __init__(self, queried):
+        self.queried = queried
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def get_messages(self, message_filter, page_size):
+        self.queried.append(message_filter.start_date)
+        message_time = datetime.fromtimestamp(message_filter.start_date + 3600, timezone.utc)
+        return SimpleNamespace(messages=[SimpleNamespace(
+            time=message_time,
+            content=SimpleNamespace(key='corechannel', content={
+                'nodes': [], 'resource_nodes': [], 'date': message_time.date().isoformat()}),
+        )])
+
+
+class TestFetchConcurrently(unittest.TestCase):
+    """Tests the concurrent fetches."""
+
+    def test_failed_requests_are_retried(self):
+        attempts = {}
+
+        async def fetch_item(key):
+            attempts[key] = attempts.get(key, 0) + 1
+            await asyncio.sleep(0.01 * (5 - key))
+            if key % 2 and attempts[key] < 3:
+                raise aiohttp.ClientError(f"failed {key}")
+            return key * 10
+
+        async def collect():
+            return [item async for item in fetcher.fetch_concurrently(fetch_item, range(5), concurrency=2,
+                                                                      retries=2, backoff=0)]
+
+        # results are in key order, whatever the order they completed in
+        self.assertEqual(asyncio.run(collect()), [(key, key * 10) for key in range(5)])
+        self.assertEqual(attempts, {0: 1, 1: 3, 2: 1, 3: 3, 4: 1})
+
+    def test_retries_are_bounded(self):
+        async def fetch_item(key):
+            raise asyncio.TimeoutError()
+
+        async def collect():
+            return [item async for item in fetcher.fetch_concurrently(fetch_item, range(5), retries=1,
+                                                                      backoff=0)]
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(collect())
+
+    def test_pending_fetches_are_cancelled(self):
+        started, cancelled = [], []
+
+        async def fetch_item(key):
+            started.append(key)
+            if key == 0:
+                return key
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(key)
+                raise
+
+        async def first_item():
+            items = fetcher.fetch_concurrently(fetch_item, range(100), concurrency=4)
+            async for item in items:
+                await items.aclose()
+                # let the cancelled tasks run
+                await asyncio.sleep(0)
+                return item, len(asyncio.all_tasks())
+
+        # nothing is left running but this task
+        self.assertEqual(asyncio.run(first_item()), ((0, 0), 1))
+        # only a bounded number of fetches were started, and they were all cancelled
+        self.assertLessEqual(len(started), 8)
+        self.assertEqual(sorted(cancelled), sorted(started[1:]))
+
+
+class TestCorechannelStatuses(unittest.TestCase):
+    """Tests the stored corechannel statuses and their backfill."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.today = int(datetime.now(timezone.utc).timestamp() // DAY) * DAY
+        self.settings = dict(get_settings(), db_path=self.tmpdir.name, reward_start_ts=self.today - 5 * DAY)
+        self.dbs = get_dbs(self.settings)
+        self.queried = []
+
+    def tearDown(self):
+        close_dbs(self.dbs)
+        self.tmpdir.cleanup()
+
+    def get_statuses(self, start_key=None):
+        async def collect():
+            return [(key, status) async for key, status
+                    in fetcher.get_corechanel_statuses(self.settings, self.dbs, start_key=start_key)]
+
+        with mock.patch.object(fetcher, 'AlephHttpClient', lambda api_server: FakeAlephClient(self.queried)):
+            return asyncio.run(collect())
+
+    def test_missing_days_are_backfilled(self):
+        db = self.dbs['corechannel_status']
+        for day in [0, 2]:
+            date = get_date(self.today - (5 - day) * DAY)
+            asyncio.run(db.store_entry(date, {'nodes': [], 'resource_nodes': [], 'date': date}))
+
+        statuses = self.get_statuses()
+        expected_dates = [get_date(self.today - (5 - day) * DAY) for day in range(6)]
+        self.assertEqual([key for key, _ in statuses], expected_dates)
+        self.assertEqual([status['date'] for _, status in statuses], expected_dates)
+        self.assertEqual(self.queried, [self.today - (5 - day) * DAY for day in [1, 3, 4, 5]])
+
+        # everything is stored now, nothing is queried again
+        self.queried.clear()
+        self.assertEqual([key for key, _ in self.get_statuses(start_key=expected_dates[3])],
+                         expected_dates[3:])
+        self.assertEqual(self.queried, [])
+
+    def test_snapshot_interval_in_days(self):
+        for interval in [3600, 86400 + 3600, 0]:
+            with self.assertRaises(ValueError):
+                asyncio.run(fetcher.get_missing_buckets(dict(self.settings, snapshot_interval=interval),
+                                                        self.dbs['corechannel_status'], self.today))
+
+        # one bucket every two days, the stored day covers its bucket
+        db = self.dbs['corechannel_status']
+        asyncio.run(db.store_entry(get_date(self.today - 4 * DAY), {}))
+        settings = dict(self.settings, snapshot_interval=2 * DAY)
+        first_bucket = fetcher.get_snapshot_bucket(settings, self.settings['reward_start_ts'])
+        buckets = asyncio.run(fetcher.get_missing_buckets(settings, db, self.today))
+        self.assertEqual(buckets, [bucket for bucket in range(first_bucket, self.today + 1, 2 * DAY)
+                                   if bucket != fetcher.get_snapshot_bucket(settings, self.today - 4 * DAY)])
+
+    def test_backfilled_days_before_the_start_key(self):
+        db = self.dbs['corechannel_status']
+        dates = [get_date(self.today - (5 - day) * DAY) for day in range(6)]
+        for day in [0, 2, 3]:
+            asyncio.run(db.store_entry(dates[day], {'nodes': [], 'resource_nodes': [], 'date': dates[day]}))
+
+        statuses = self.get_statuses(start_key=dates[3])
+        self.assertEqual([key for key, _ in statuses], [dates[1]] + dates[3:])
@@ -3,11 +3,40 @@
 """Tests for `ltai_points` package."""
 
 
+import asyncio
+import copy
+import io
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta, timezone
 import unittest
+from unittest import mock
 from click.testing import CliRunner
 
 from ltai_points import ltai_points
 from ltai_points import cli
+from ltai_points.clusters import AddressClusters
+from ltai_points.context import RunContext
+from ltai_points.profiling import run_report
+from ltai_points.settings import get_settings
+from ltai_points.sinks import StreamSink, get_output_sink, write_points
+from ltai_points.snapshot import SnapshotCache
+from ltai_points.storage import close_dbs, get_dbs
+from ltai_points.supply import get_supply_info
+from tests.benchmarks.generators import SCALES, make_address, make_status
+
+SUPPLY_FILENAME = os.path.join(os.path.dirname(__file__), '..', 'sample_supply.yaml')
+# (nodes, resource nodes, stakers) of the statuses
+STATUS_SCALE = SCALES['small']
+# the clock of the points computations
+FROZEN_NOW = datetime(2024, 3, 15, 15, 30, tzinfo=timezone.utc)
+
+
+class FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return FROZEN_NOW.astimezone(tz) if tz is not None else FROZEN_NOW.replace(tzinfo=None)
 
 
 class TestLtai_points(unittest.TestCase):
@@ -15,6 +44,10 @@ class TestLtai_points(unittest.TestCase):
 
     def setUp(self):
         """Set up test fixtures, if any."""
+        self.settings = get_settings()
+        self.settings['bonus_addresses'] = [make_address(400001)]
+        self.registrations = {make_address(400000 + i): self.settings['bonus_limit_ts'] - 86400 * i
+                              for i in range(1, 50)}
 
     def tearDown(self):
         """Tear down test fixtures, if any."""
@@ -22,6 +55,193 @@ class TestLtai_points(unittest.TestCase):
     def test_000_something(self):
         """Test something."""
 
+    def test_estimated_rounds_match(self):
+        """The closed-form estimate gives the same points as simulating every day."""
+        status = make_status(1, *STATUS_SCALE, edge_cases=True)
+        start_date = date(2024, 2, 10)  # the bonus window ends during the estimate
+        days = 40
+        expected, result = {}, {}
+        for i in range(days):
+            asyncio.run(ltai_points.process_virtual_daily_round(
+                (start_date + timedelta(days=i)).isoformat(), status, expected,
+                self.registrations, self.settings))
+        asyncio.run(ltai_points.process_estimated_rounds(
+            start_date.isoformat(), status, result, self.registrations, self.settings, days))
+
+        self.assertPointsEqual(expected, result)
+
+    def test_estimated_aggregate_key(self):
+        """The estimated points are published under a key named after their horizon."""
+        self.assertEqual(self.settings['estimated_aggregate_key'], 'estimated_3yr_tokens')
+        with mock.patch.dict(os.environ, {'ESTIMATE_DAYS': '180'}):
+            self.assertEqual(get_settings()['estimated_aggregate_key'], 'estimated_180d_tokens')
+        with mock.patch.dict(os.environ, {'ESTIMATE_DAYS': '180', 'ESTIMATED_AGGREGATE_KEY': 'estimates'}):
+            self.assertEqual(get_settings()['estimated_aggregate_key'], 'estimates')
+
+    def test_address_clusters(self):
+        clusters = AddressClusters()
+        # a long chain of nodes, each sharing one address with the next
+        for i in range(50):
+            clusters.link(f'node{i}', make_address(i), make_address(i + 1))
+        # a node changing its reward address only keeps the latest one
+        clusters.link('other', make_address(100), make_address(101))
+        clusters.link('other', make_address(100), make_address(102))
+
+        self.assertEqual(len(clusters), 2)
+        self.assertEqual(set(clusters.get_members(make_address(50))), set(make_address(i) for i in range(51)))
+        self.assertEqual(clusters.find(make_address(100)), clusters.find(make_address(102)))
+        self.assertEqual(clusters.get_members(make_address(101)), [make_address(101)])
+        self.assertEqual(clusters.get_members(make_address(200)), [make_address(200)])
+        self.assertEqual(clusters.get_totals({make_address(0): 1, make_address(50): 2, make_address(200): 3}),
+                         {clusters.find(make_address(0)): 3, make_address(200): 3})
+
+    def test_run_contexts_are_isolated(self):
+        """Concurrent rounds only link addresses in their own run context."""
+        contexts = [RunContext(self.settings), RunContext(self.settings)]
+        links = [[], []]
+
+        async def run():
+            await asyncio.gather(*[
+                ltai_points.process_virtual_daily_round(
+                    '2024-03-01', make_status(seed, *STATUS_SCALE, edge_cases=True), {}, self.registrations,
+                    self.settings, links=links[seed], context=contexts[seed])
+                for seed in range(2)])
+        asyncio.run(run())
+
+        for context, context_links in zip(contexts, links):
+            expected = AddressClusters()
+            for link in context_links:
+                expected.link(*link)
+            self.assertEqual(set(context.clusters.parents), set(expected.parents))
+            for address in expected.parents:
+                self.assertEqual(set(context.clusters.get_members(address)), set(expected.get_members(address)))
+
+    def test_output_sinks(self):
+        totals = {make_address(1): 10.5, make_address(2): 3}
+        pending = {make_address(2): 1.25}
+        bonus = frozenset([make_address(1)])
+
+        stream = io.StringIO()
+        write_points(StreamSink(stream), totals, pending, bonus)
+        self.assertEqual(stream.getvalue().splitlines(), [
+            f'totals\t{make_address(1)}\t10.5\t1',
+            f'totals\t{make_address(2)}\t3\t0',
+            f'pending\t{make_address(2)}\t1.25\t',
+        ])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'points.jsonl')
+            sink = get_output_sink(dict(self.settings, output_sink='jsonl', output_path=path))
+            write_points(sink, totals, pending, bonus)
+            sink.close()
+            with open(path) as f:
+                rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[0], {'section': 'totals', 'address': make_address(1), 'points': 10.5, 'bonus': True})
+        self.assertEqual(rows[2], {'section': 'pending', 'address': make_address(2), 'points': 1.25})
+
+    def test_prepared_snapshot_cache(self):
+        cache = SnapshotCache(size=2)
+        status = make_status(0, *STATUS_SCALE, edge_cases=True)
+        snapshot = cache.get(status)
+        self.assertIs(cache.get(status), snapshot)
+        # snapshots are found by the identity of their status, not its content
+        self.assertIsNot(cache.get(copy.deepcopy(status)), snapshot)
+        self.assertEqual(snapshot.total_staked, sum(ltai_points.compute_staked_amounts(status).values()))
+
+        for seed in range(1, 3):
+            cache.get(make_status(seed, *STATUS_SCALE, edge_cases=True))
+        self.assertIsNot(cache.get(status), snapshot)
+
+    def compute_points(self, dbs, history, registrations):
+        async def get_corechanel_statuses(settings, dbs, start_key=None):
+            # like the fetcher: the stored days from start_key on, and the days fetched now
+            db = dbs['corechannel_status']
+            for ddate, status in history:
+                fetched = await db.get_entry(ddate) is None
+                if fetched:
+                    await db.store_entry(ddate, {})
+                if fetched or start_key is None or ddate >= start_key:
+                    yield ddate, status
+
+        async def get_account_registrations(settings):
+            return registrations, {address: 1 for address in registrations}
+
+        pools, max_supply, allocations = get_supply_info(self.settings)
+        balances = {make_address(400000 + i): 100 for i in range(50)}
+        last_distribution = FROZEN_NOW - timedelta(days=3, hours=5)
+        with mock.patch.object(ltai_points, 'datetime', FrozenDatetime), \
+                mock.patch.object(ltai_points, 'get_corechanel_statuses', get_corechanel_statuses), \
+                mock.patch.object(ltai_points, 'get_account_registrations', get_account_registrations), \
+                run_report() as report:
+            result = asyncio.run(ltai_points.compute_points(
+                self.settings, dbs, dict(balances), balances, pools, allocations,
+                last_distribution.timestamp(), {}))
+        return result[:3], report.counters
+
+    def assertPointsEqual(self, expected, result):
+        self.assertEqual(set(expected), set(result))
+        for address, value in expected.items():
+            self.assertAlmostEqual(value, result[address], delta=1e-9 * max(1, abs(value)))
+
+    def test_ledger_replay_matches_cold_run(self):
+        self.settings['supply_filename'] = SUPPLY_FILENAME
+        today = FROZEN_NOW.date()
+        history = [((today - timedelta(days=19 - i)).isoformat(), make_status(i, *STATUS_SCALE, edge_cases=True))
+                   for i in range(20)]
+        registrations = {ltai_points.to_checksum_address(make_address(400000 + i)): self.settings['reward_start_ts']
+                         for i in range(10)}
+
+        with tempfile.TemporaryDirectory() as cold_path, tempfile.TemporaryDirectory() as ledger_path:
+            cold_dbs = get_dbs(dict(self.settings, db_path=cold_path))
+            ledger_dbs = get_dbs(dict(self.settings, db_path=ledger_path))
+            try:
+                expected, counters = self.compute_points(cold_dbs, history, registrations)
+                self.assertEqual(counters.get('ledger_days_replayed', 0), 0)
+
+                # the days before today are in the ledger now, the second run replays them
+                self.compute_points(ledger_dbs, history, registrations)
+                result, counters = self.compute_points(ledger_dbs, history, registrations)
+                self.assertEqual(counters['ledger_days_replayed'], 19)
+                self.assertEqual(counters.get('days_computed', 0), 0)
+            finally:
+                close_dbs(cold_dbs)
+                close_dbs(ledger_dbs)
+
+        for expected_points, points in zip(expected, result):
+            self.assertPointsEqual(expected_points, points)
+
+    def test_ledger_backfilled_day(self):
+        self.settings['supply_filename'] = SUPPLY_FILENAME
+        today = FROZEN_NOW.date()
+        history = [((today - timedelta(days=19 - i)).isoformat(), make_status(i, *STATUS_SCALE, edge_cases=True))
+                   for i in range(20)]
+        # a day before the last ledger entry, only published later
+        backfilled = history[8]
+        registrations = {ltai_points.to_checksum_address(make_address(400000 + i)): self.settings['reward_start_ts']
+                         for i in range(10)}
+
+        with tempfile.TemporaryDirectory() as cold_path, tempfile.TemporaryDirectory() as ledger_path:
+            cold_dbs = get_dbs(dict(self.settings, db_path=cold_path))
+            ledger_dbs = get_dbs(dict(self.settings, db_path=ledger_path))
+            try:
+                expected, _ = self.compute_points(cold_dbs, history, registrations)
+
+                self.compute_points(ledger_dbs, [day for day in history if day is not backfilled], registrations)
+                result, counters = self.compute_points(ledger_dbs, history, registrations)
+                self.assertEqual(counters['days_computed'], 1)
+                self.assertEqual(counters['ledger_days_replayed'], 18)
+
+                # it is in the ledger as well now
+                result, counters = self.compute_points(ledger_dbs, history, registrations)
+                self.assertEqual(counters.get('days_computed', 0), 0)
+                self.assertEqual(counters['ledger_days_replayed'], 19)
+            finally:
+                close_dbs(cold_dbs)
+                close_dbs(ledger_dbs)
+
+        for expected_points, points in zip(expected, result):
+            self.assertPointsEqual(expected_points, points)
+
     def test_command_line_interface(self):
         """Test the CLI."""
         runner = CliRunner()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""Tests for the `ltai_points.storage` module."""
+
+import asyncio
+import copy
+import os
+import random
+import tempfile
+import unittest
+
+from ltai_points import storage
+from ltai_points.settings import get_settings
+from ltai_points.storage import DELTA_MARKER, DeltaStorage, Storage, get_codec, get_dbs, close_dbs, migrate_dbs
+from tests.benchmarks.generators import SCALES, make_address, make_status
+
+BINARY_CODECS = ['msgpack', 'msgpack+zstd']
+# first byte of the entries written with each codec
+CODEC_PREFIXES = {'json': b'{', 'msgpack': storage.MSGPACK_VERSION, 'msgpack+zstd': storage.MSGPACK_ZSTD_VERSION}
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.storages = []
+
+    def tearDown(self):
+        for db in self.storages:
+            db.close()
+        self.tmpdir.cleanup()
+
+    def open(self, storage_class, name, **kwargs):
+        db = storage_class(self.tmpdir.name, name, **kwargs)
+        self.storages.append(db)
+        return db
+
+    def reopen(self, db, storage_class, **kwargs):
+        self.storages.remove(db)
+        db.close()
+        return self.open(storage_class, os.path.basename(db.db_path), **kwargs)
+
+    def retrieve(self, db, **kwargs):
+        async def collect():
+            return [item async for item in db.retrieve_entries(**kwargs)]
+        return asyncio.run(collect())
+
+
+def make_history(days, seed=0):
+    """ (date, status) of `days` consecutive days, each changing a few nodes of the previous one """
+    rnd = random.Random(seed)
+    status = make_status(seed, *SCALES['small'], edge_cases=True)
+    history = []
+    for day in range(days):
+        status = copy.deepcopy(status)
+        for node in status['nodes']:
+            if rnd.random() < 0.3:
+                node['score'] = rnd.random()
+            if rnd.random() < 0.1 and node['stakers']:
+                node['stakers'].pop(next(iter(node['stakers'])))
+            if rnd.random() < 0.1:
+                node['stakers'][make_address(40000 + rnd.randrange(1000))] = rnd.random()
+        if rnd.random() < 0.2:
+            status['nodes'].pop(rnd.randrange(len(status['nodes'])))
+        history.append((f'2024-01-{day + 1:02d}', status))
+    return history
+
+
+@unittest.skipIf(storage.msgpack is None or storage.zstandard is None, "msgpack and zstandard are not installed")
+class TestCodecs(StorageTestCase):
+    """Tests the storage codecs and the migration between them."""
+
+    def test_round_trips(self):
+        status = make_status(0, *SCALES['small'], edge_cases=True)
+        for name in ['json'] + BINARY_CODECS:
+            codec = get_codec(name)
+            self.assertEqual(storage.decode_entry(codec.encode(status)), status, name)
+
+        with self.assertRaises(ValueError):
+            get_codec('pickle')
+
+    def test_mixed_codecs_are_read(self):
+        db = self.open(Storage, 'mixed')
+        asyncio.run(db.store_entry('2024-01-01', {'codec': 'json'}))
+        for i, name in enumerate(BINARY_CODECS):
+            db = self.reopen(db, Storage, codec=name)
+            asyncio.run(db.store_entry(f'2024-01-0{i + 2}', {'codec': name}))
+
+        self.assertEqual(self.retrieve(db), [('2024-01-01', {'codec': 'json'}),
+                                             ('2024-01-02', {'codec': 'msgpack'}),
+                                             ('2024-01-03', {'codec': 'msgpack+zstd'})])
+
+    def test_migrate(self):
+        db = self.open(Storage, 'legacy')
+        status = make_status(1, *SCALES['small'], edge_cases=True)
+        asyncio.run(db.store_entry('2024-01-01', status))
+        asyncio.run(db.namespace('other').store_entry('2024-01-02', {'a': 1}))
+
+        for name in BINARY_CODECS + ['json']:
+            db = self.reopen(db, Storage, codec=name)
+            # every namespace is rewritten
+            self.assertEqual(asyncio.run(db.migrate()), 2)
+            self.assertEqual(db.db.get(b'item:2024-01-01')[:1], CODEC_PREFIXES[name])
+            self.assertEqual(self.retrieve(db), [('2024-01-01', status)])
+            self.assertEqual(self.retrieve(db.namespace('other')), [('2024-01-02', {'a': 1})])
+
+    def test_migrate_dbs(self):
+        settings = dict(get_settings(), db_path=self.tmpdir.name)
+        dbs = get_dbs(settings)
+        try:
+            asyncio.run(dbs['staked_amounts'].store_entry('2024-01-01', {'a': 1}))
+        finally:
+            close_dbs(dbs)
+
+        dbs = get_dbs(dict(settings, storage_codec='msgpack+zstd'))
+        try:
+            asyncio.run(migrate_dbs(dbs))
+            self.assertEqual(dbs['staked_amounts'].db.get(b'item:2024-01-01')[:1], CODEC_PREFIXES['msgpack+zstd'])
+            self.assertEqual(self.retrieve(dbs['staked_amounts']), [('2024-01-01', {'a': 1})])
+        finally:
+            close_dbs(dbs)
+
+
+class TestDeltaStorage(StorageTestCase):
+    """Tests the delta encoded storage."""
+
+    def test_round_trips(self):
+        history = make_history(25)
+        db = self.open(DeltaStorage, 'delta', keyframe_interval=10)
+        # one day stored late, between two stored ones
+        for key, status in history[:11] + history[12:] + history[11:12]:
+            asyncio.run(db.store_entry(key, status))
+
+        self.assertEqual(self.retrieve(db), history)
+        self.assertEqual(self.retrieve(db, start_key=history[5][0], end_key=history[15][0]), history[5:16])
+        self.assertEqual(asyncio.run(db.get_entry(history[18][0])), history[18][1])
+
+        # a keyframe every 10 entries, diffs in between
+        frames = [storage.decode_entry(db.db.get(f'item:{key}'.encode())) for key, _ in history]
+        keyframes = [i for i, frame in enumerate(frames) if DELTA_MARKER not in frame]
+        self.assertEqual(keyframes[:2], [0, 10])
+        self.assertTrue(all(frame[DELTA_MARKER]['depth'] < 10 for frame in frames if DELTA_MARKER in frame))
+
+    def test_entries_are_not_overwritten(self):
+        history = make_history(3)
+        db = self.open(DeltaStorage, 'delta')
+        for key, status in history:
+            asyncio.run(db.store_entry(key, status))
+        asyncio.run(db.store_entry(history[1][0], {'nodes': [], 'resource_nodes': []}))
+        self.assertEqual(self.retrieve(db), history)
+
+    def test_migrate(self):
+        history = make_history(12)
+        db = self.open(Storage, 'corechannel_status')
+        for key, status in history:
+            asyncio.run(db.store_entry(key, status))
+
+        db = self.reopen(db, DeltaStorage, keyframe_interval=5)
+        self.assertEqual(asyncio.run(db.migrate()), 12)
+        frames = [storage.decode_entry(db.db.get(f'item:{key}'.encode())) for key, _ in history]
+        self.assertEqual([i for i, frame in enumerate(frames) if DELTA_MARKER not in frame], [0, 5, 10])
+        self.assertEqual(self.retrieve(db), history)
+
+        # and entries stored after the migration still decode
+        next_status = dict(history[-1][1], nodes=history[-1][1]['nodes'][1:])
+        asyncio.run(db.store_entry('2024-01-13', next_status))
+        self.assertEqual(self.retrieve(db)[-1], ('2024-01-13', next_status))
+
+
+class TestStorageRanges(StorageTestCase):
+    """Tests the key seeks of the storage."""
+
+    def test_last_key_and_ranges(self):
+        db = self.open(Storage, 'ranges')
+        self.assertIsNone(asyncio.run(db.get_last_available_key()))
+
+        keys = ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04']
+        for key in keys:
+            asyncio.run(db.store_entry(key, {'key': key}))
+        # keys around the items and in a namespace are never returned
+        db.db.put(b'aaa', b'{}')
+        db.db.put(b'other:zzz', b'{}')
+        asyncio.run(db.namespace('later').store_entry('2030-01-01', {}))
+
+        async def retrieve_keys(**kwargs):
+            return [key async for key in db.retrieve_keys(**kwargs)]
+
+        self.assertEqual(asyncio.run(db.get_last_available_key()), '2024-01-04')
+        self.assertEqual(asyncio.run(db.namespace('later').get_last_available_key()), '2030-01-01')
+        self.assertEqual(asyncio.run(retrieve_keys()), keys)
+        self.assertEqual(asyncio.run(retrieve_keys(start_key='2024-01-02', end_key='2024-01-03')), keys[1:3])
+        self.assertEqual([key for key, _ in self.retrieve(db, start_key='2024-01-02')], keys[1:])
+        self.assertEqual([key for key, _ in self.retrieve(db, end_key='2024-01-02')], keys[:2])
+        # bounds between keys
+        self.assertEqual(asyncio.run(retrieve_keys(start_key='2024-01-01T12', end_key='2024-01-03T12')),
+                         keys[1:3])
+        self.assertEqual(asyncio.run(db.count_entries()), 4)
+        self.assertEqual(asyncio.run(db.count_entries(start_key='2024-01-03')), 2)